@@ -0,0 +1,191 @@
+import heapq
+
+from .dialog import ATOM_BRANCH, DEFAULT_START_TIME, DEFAULT_MESSAGE_BUFFER
+
+# How a chain of passages (followed through first links) comes to an end
+CHAIN_END = 'end'
+CHAIN_PROMPT = 'prompt'
+CHAIN_LOOP = 'loop'
+CHAIN_BROKEN = 'broken'
+
+
+class DialogAnalysis(object):
+    def __init__(self, dialog):
+        # Checks a dialog the way compile will walk it, without raising on the first problem.  Every
+        # passage is parsed and followed once, chains of passages are memoized by the passage they start
+        # from so branches sharing a tail don't walk it again.
+        self.dialog = dialog
+        self.errors = []
+        self.warnings = []
+        self.nodes = {}
+        self.chains = {}
+        self.branches = []
+        self.dead_ends = []
+        self.unreachable = []
+        self.fan_out = 0
+        self.shortest = None
+        self.analyze()
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def get_node(self, name):
+        # Parsed passage, None for missing passages or passages whose tags can't be parsed
+        if name in self.nodes:
+            return self.nodes[name]
+        passage = self.dialog.passages.get(name)
+        if name == self.dialog.starting_passage.get('name'):
+            passage = self.dialog.starting_passage
+        node = None
+        if passage:
+            try:
+                node = self.dialog.get_node(passage)
+            except Exception as e:
+                self.errors.append(str(e))
+        self.nodes.update({name: node})
+        return node
+
+    def get_target(self, node, link):
+        # Links are only followed to passages other than the starting passage, see Dialog.follow
+        name = link.get('link')
+        if name not in self.dialog.passages:
+            self.errors.append("Passage '%s' links to missing passage '%s'" % (node.name, name))
+            return None
+        return self.get_node(name)
+
+    def get_chain(self, node):
+        # Duration and passages from node to the end of its chain, along with how it ends and the
+        # passage it ends on.  Walked iteratively, every passage on the way is memoized.
+        walked = []
+        walking = set()
+        chain = None
+        while node is not None and chain is None:
+            chain = self.chains.get(node.name)
+            if chain is not None:
+                break
+            if node.name in walking:
+                self.errors.append("Dialog loops back to passage '%s' without a prompt" % node.name)
+                chain = (0.0, 0, CHAIN_LOOP, node.name)
+                break
+            walked.append(node)
+            walking.add(node.name)
+            if not node.links:
+                chain = (0.0, 0, CHAIN_END, node.name)
+            elif node.prompt:
+                chain = (0.0, 0, CHAIN_PROMPT, node.name)
+            else:
+                if len(node.links) > 1:
+                    self.warnings.append("Passage '%s' isn't a prompt, only its first link is followed" % node.name)
+                next_node = self.get_target(node, node.links[0])
+                if next_node is None:
+                    chain = (0.0, 0, CHAIN_BROKEN, node.name)
+                node = next_node
+        if chain is None:
+            chain = (0.0, 0, CHAIN_BROKEN, None)
+        for node in reversed(walked):
+            chain = (chain[0] + node.duration + DEFAULT_MESSAGE_BUFFER, chain[1] + 1, chain[2], chain[3])
+            self.chains.update({node.name: chain})
+        return chain
+
+    def analyze(self):
+        # Branches in the order compile numbers them, each one a chain starting at the first passage
+        # or a prompt's link
+        start = self.get_node(self.dialog.starting_passage.get('name'))
+        branch_ids = {}
+        branch_links = {}
+        stack = [start] if start else []
+        while stack:
+            node = stack.pop()
+            if node.name in branch_ids:
+                continue
+            branch_id = '%s#%d' % (ATOM_BRANCH, len(self.branches) + 1)
+            branch_ids.update({node.name: branch_id})
+            duration, passages, status, last_name = self.get_chain(node)
+            targets = []
+            if status == CHAIN_PROMPT:
+                last = self.nodes[last_name]
+                self.fan_out = max(self.fan_out, len(last.links))
+                targets = [x for x in [self.get_target(last, link) for link in last.links] if x is not None]
+                stack += list(reversed(targets))
+            elif status == CHAIN_END:
+                self.dead_ends.append(last_name)
+            branch_links.update({node.name: [x.name for x in targets]})
+            self.branches.append({
+                'id': branch_id,
+                'start': node.name,
+                'end': last_name,
+                'status': status,
+                'passages': passages,
+                'duration': round(DEFAULT_START_TIME + duration, 3)
+            })
+
+        # Every passage on a chain is reachable
+        reachable = set(self.chains.keys())
+        self.unreachable = [name for name in self.dialog.passages.keys() if name not in reachable]
+        for name in self.unreachable:
+            self.warnings.append("Passage '%s' can't be reached" % name)
+        self.dead_ends = sorted(set(self.dead_ends))
+        self.check_endings(branch_links)
+
+        # Branches sharing a prompt follow its links more than once, report each problem once
+        self.errors = list(dict.fromkeys(self.errors))
+        self.warnings = list(dict.fromkeys(self.warnings))
+
+    def check_endings(self, branch_links):
+        # Shortest time to reach an ending from the first passage, and branches (ie, prompts looping
+        # back on each other) from which no ending can be reached at all
+        durations = {x['start']: x['duration'] for x in self.branches}
+        endings = {x['start'] for x in self.branches if x['status'] == CHAIN_END}
+        if not self.branches:
+            return
+        queue = [(durations[self.branches[0]['start']], self.branches[0]['start'])]
+        visited = set()
+        while queue:
+            elapsed, name = heapq.heappop(queue)
+            if name in visited:
+                continue
+            visited.add(name)
+            if name in endings:
+                self.shortest = round(elapsed, 3)
+                break
+            for target in branch_links.get(name, []):
+                if target not in visited:
+                    heapq.heappush(queue, (elapsed + durations[target], target))
+
+        # Walk back from the endings through the branches linking to them
+        linked_from = {}
+        for name, targets in branch_links.items():
+            for target in targets:
+                linked_from.setdefault(target, []).append(name)
+        can_end = set(endings)
+        stack = list(endings)
+        while stack:
+            for name in linked_from.get(stack.pop(), []):
+                if name not in can_end:
+                    can_end.add(name)
+                    stack.append(name)
+        for branch in self.branches:
+            if branch['start'] not in can_end and branch['status'] == CHAIN_PROMPT:
+                self.warnings.append("No ending can be reached from passage '%s'" % branch['start'])
+
+    def report(self):
+        return {
+            'passages': len(self.dialog.passages) + 1,
+            'reachable': len(self.chains),
+            'branches': self.branches,
+            'fan_out': self.fan_out,
+            'shortest': self.shortest,
+            'longest_branch': max([x['duration'] for x in self.branches], default=0),
+            'dead_ends': self.dead_ends,
+            'unreachable': self.unreachable,
+            'errors': self.errors,
+            'warnings': self.warnings
+        }
+
+
+def analyze(dialog):
+    # Dialogs are shared between scenes and builds until they change, so is their analysis
+    if dialog.analysis is None:
+        dialog.analysis = DialogAnalysis(dialog)
+    return dialog.analysis
@@ -0,0 +1,31 @@
+from .scaffold import Scaffold
+from .template import TemplateRegistry, MemoryTemplateRegistry
+from .sinks import SceneSink, CallbackSink
+from . import serializer
+
+
+def get_templates(templates):
+    # Templates are given as a directory, a template registry or by name as parsed json or raw bytes
+    if isinstance(templates, (str, TemplateRegistry)):
+        return templates
+    return MemoryTemplateRegistry(templates)
+
+
+def get_sink(sink):
+    # Sinks are given as a SceneSink or a callable receiving each scene path and scene
+    if sink is None or isinstance(sink, SceneSink):
+        return sink
+    if callable(sink):
+        return CallbackSink(sink)
+    raise Exception("Invalid scene sink: %s" % sink)
+
+
+def scaffold(blueprint, templates, scenes=None, dialogs=None, sink=None, name='project', weights=False,
+             check=False):
+    # Build a blueprint's scenes in memory and return them by scene path, built scenes are also
+    # streamed to the sink (if any) as each one is finished.  See Scaffold.build for scenes and dialogs.
+    if isinstance(blueprint, (bytes, str)):
+        blueprint = serializer.loads(blueprint)
+    project = Scaffold(name, blueprint, get_templates(templates), weights=weights, sink=get_sink(sink),
+                       check=check)
+    return project.build(scenes, dialogs)
@@ -0,0 +1,231 @@
+import os
+import sys
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+
+from .project import Project
+from .template import TemplateRegistry
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Project methods timed by the benchmark, in the order scaffold calls them
+PHASES = [
+    'get_package_atoms',
+    'scan_scenes',
+    'load_scenes',
+    'get_dialog_atoms',
+    'pack_scenes',
+    'get_backfill_atoms',
+    'build_dialog',
+    'save_scenes'
+]
+
+DIALOG_SHAPES = ['linear', 'tree', 'mixed']
+
+SPEAKERS = ['Guy', 'Girl']
+
+
+def generate_dialog(size, shape='mixed', fan_out=3):
+    # Twison formatted dialog with `size` passages.  Linear dialogs are a single chain, trees
+    # prompt at every passage and mixed dialogs run short chains of passages between prompts.
+    names = ['Start'] + ['%05d' % idx for idx in range(1, size)]
+    passages = []
+    for idx, name in enumerate(names):
+        speaker = SPEAKERS[idx % len(SPEAKERS)]
+        if shape == 'tree':
+            prompt = True
+            targets = [names[child] for child in range(idx * fan_out + 1, idx * fan_out + fan_out + 1) if child < size]
+        elif shape == 'linear':
+            prompt = False
+            targets = names[idx + 1:idx + 2]
+        else:
+            prompt = idx % (fan_out + 2) == fan_out + 1
+            targets = names[idx + 1:idx + 1 + (fan_out if prompt else 1)]
+        links = [{'name': 'GREEN:Go to %s' % target, 'link': target} for target in targets]
+        passages.append({
+            'name': name,
+            'text': 'Passage %s\n\n%s' % (name, '\n'.join('[[%s->%s]]' % (x['name'], x['link']) for x in links)),
+            'links': links,
+            'tags': [speaker, 'says', 'prompt'] if prompt and links else [speaker, 'says']
+        })
+    return {'passages': passages}
+
+
+def generate_project(root_path, templates_path, scene_count=10, packages=None, unique_atoms=5,
+                     unique_atom_package='Toy', dialog_size=0, dialog_shape='mixed', dialog_fan_out=3):
+    # Lays out a VAM directory and a project with source scenes, packages and dialog under root_path
+    templates = TemplateRegistry.get_registry(templates_path)
+    name = 'vsb-benchmark'
+    projects_path = os.path.join(root_path, 'projects')
+    scenes_path = os.path.join(root_path, 'VAM', 'Saves', 'scene')
+    source_path = os.path.join(scenes_path, name)
+    project_path = os.path.join(projects_path, name)
+    for path in [source_path, os.path.join(project_path, 'dialog')]:
+        os.makedirs(path, exist_ok=True)
+
+    if dialog_size:
+        dialog = generate_dialog(dialog_size, dialog_shape, dialog_fan_out)
+        serializer.dump(dialog, os.path.join(project_path, 'dialog', 'dialog.json'))
+
+    scenes = []
+    for scene_idx in range(scene_count):
+        scene_path = 'scene%03d.json' % (scene_idx + 1)
+        scene_data = templates.render('scene')
+        for atom_idx in range(unique_atoms):
+            atom_id = 'S%03d-%s#%d' % (scene_idx + 1, unique_atom_package, atom_idx + 1)
+            scene_data['atoms'] += templates.render('packages/%s' % unique_atom_package, ID=atom_id)
+        serializer.dump(scene_data, os.path.join(source_path, scene_path))
+        scenes.append({'scene_path': scene_path, 'dialog_path': 'dialog/dialog.json'} if dialog_size else scene_path)
+
+    blueprint = {'packages': packages or {}, 'scenes': scenes}
+    serializer.dump(blueprint, os.path.join(project_path, 'blueprint.json'), pretty=True)
+    return name, projects_path, scenes_path
+
+
+def instrument(project, timings):
+    # Wrap the project's phase methods so every call is timed
+    for phase in PHASES:
+        method = getattr(project, phase)
+
+        def timed(*args, _method=method, _phase=phase, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                timing = timings.setdefault(_phase, {'calls': 0, 'time': 0.0})
+                timing['calls'] += 1
+                timing['time'] += time.perf_counter() - start
+        setattr(project, phase, timed)
+
+
+class Benchmark(object):
+    def __init__(self, templates_path, scene_count=10, packages=None, unique_atoms=5, unique_atom_package='Toy',
+                 dialog_size=0, dialog_shape='mixed', dialog_fan_out=3, workers=1, trace_memory=True,
+                 low_memory=False):
+        if dialog_shape not in DIALOG_SHAPES:
+            raise Exception("Invalid dialog shape: %s" % dialog_shape)
+        self.templates_path = templates_path
+        self.params = {
+            'scene_count': scene_count,
+            'packages': packages or {},
+            'unique_atoms': unique_atoms,
+            'unique_atom_package': unique_atom_package,
+            'dialog_size': dialog_size,
+            'dialog_shape': dialog_shape,
+            'dialog_fan_out': dialog_fan_out,
+            'workers': workers,
+            'low_memory': low_memory
+        }
+        self.trace_memory = trace_memory
+
+    def run(self, repeat=1):
+        root_path = tempfile.mkdtemp(prefix='vsb-benchmark-')
+        try:
+            name, projects_path, scenes_path = generate_project(
+                root_path, self.templates_path,
+                **{key: value for key, value in self.params.items() if key not in ['workers', 'low_memory']})
+            runs = [self.run_once(name, projects_path, scenes_path) for _ in range(repeat)]
+        finally:
+            shutil.rmtree(root_path, ignore_errors=True)
+        return {
+            'params': self.params,
+            'environment': {
+                'python': sys.version.split()[0],
+                'platform': platform.platform()
+            },
+            'best': min(runs, key=lambda x: x['total']),
+            'runs': runs
+        }
+
+    def run_once(self, name, projects_path, scenes_path):
+        timings = {}
+        project = Project(
+            name=name,
+            projects_path=projects_path,
+            templates_path=self.templates_path,
+            scenes_path=scenes_path,
+            workers=self.params.get('workers'),
+            low_memory=self.params.get('low_memory')
+        )
+        instrument(project, timings)
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            project.scaffold(force=True)
+            total = time.perf_counter() - start
+            peak_memory = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+        output_bytes = sum(os.path.getsize(os.path.join(dirpath, filename))
+                           for dirpath, dirnames, filenames in os.walk(project.build_path)
+                           for filename in filenames)
+        logger.info("Benchmark run finished in %.3fs", total)
+        return {
+            'total': total,
+            'phases': timings,
+            'peak_memory': peak_memory,
+            'output_bytes': output_bytes,
+            'metrics': project.metrics.report()
+        }
+
+    def run_serializers(self, repeat=3):
+        # Times every available json backend reading and writing the scenes of a scaffolded project
+        root_path = tempfile.mkdtemp(prefix='vsb-benchmark-')
+        try:
+            name, projects_path, scenes_path = generate_project(
+                root_path, self.templates_path,
+                **{key: value for key, value in self.params.items() if key not in ['workers', 'low_memory']})
+            project = Project(name=name, projects_path=projects_path, templates_path=self.templates_path,
+                              scenes_path=scenes_path)
+            project.scaffold(force=True)
+            raw_scenes = [open(project.get_build_scene_path(scene_path), 'rb').read()
+                          for scene_path in project.get_scene_configs().keys()]
+        finally:
+            shutil.rmtree(root_path, ignore_errors=True)
+
+        scenes = [serializer.loads(raw, serializer.BACKEND_JSON) for raw in raw_scenes]
+        results = {}
+        for backend in serializer.get_available_backends():
+            load_times = []
+            dump_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for raw in raw_scenes:
+                    serializer.loads(raw, backend)
+                load_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                output = [serializer.dumps(scene, backend=backend) for scene in scenes]
+                dump_times.append(time.perf_counter() - start)
+            results.update({backend: {
+                'load': min(load_times),
+                'dump': min(dump_times),
+                'bytes': sum(len(x) for x in output),
+                'identical': output == [serializer.dumps(scene, backend=serializer.BACKEND_JSON) for scene in scenes],
+                'equivalent': [serializer.loads(x, serializer.BACKEND_JSON) for x in output] == scenes
+            }})
+        return {
+            'params': self.params,
+            'scenes': len(scenes),
+            'input_bytes': sum(len(x) for x in raw_scenes),
+            'backends': results
+        }
+
+    @staticmethod
+    def compare(baseline, result):
+        # Relative change per phase between two saved results, positive values are slower
+        changes = {}
+        for phase, timing in result['best']['phases'].items():
+            previous = baseline['best']['phases'].get(phase)
+            if previous and previous['time']:
+                changes.update({phase: (timing['time'] - previous['time']) / previous['time']})
+        if baseline['best']['total']:
+            changes.update({'total': (result['best']['total'] - baseline['best']['total']) / baseline['best']['total']})
+        return changes
@@ -0,0 +1,139 @@
+import os
+import sys
+import marshal
+import hashlib
+
+from .sync import write_if_changed
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of cache entries changes, old entries are then ignored and evicted
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Cache path and size set in this process, worker processes are given their parent's (see get_settings)
+_settings = (None, DEFAULT_CACHE_SIZE)
+
+# Open caches in this process, by path
+_caches = {}
+
+
+def set_cache(cache_path, max_bytes=DEFAULT_CACHE_SIZE):
+    # None disables the cache
+    global _settings
+    _settings = (os.path.abspath(cache_path) if cache_path else None, max_bytes)
+
+
+def get_settings():
+    # Arguments to set_cache giving another process the same cache
+    return _settings
+
+
+def get_cache():
+    cache_path, max_bytes = _settings
+    if not cache_path:
+        return None
+    cache = _caches.get(cache_path)
+    if not cache:
+        cache = ParseCache(cache_path, max_bytes)
+        _caches.update({cache_path: cache})
+    return cache
+
+
+def load(filepath, interned=False):
+    # Parse a json file, going through the persistent cache if one is set
+    cache = get_cache()
+    if cache:
+        return cache.load(filepath, interned)
+    return serializer.load(filepath, interned=interned)
+
+
+class ParseCache(object):
+    def __init__(self, cache_path, max_bytes=DEFAULT_CACHE_SIZE):
+        # Parsed json is stored as marshal, which loads several times faster and keeps strings interned.
+        # Entries are named after the file they were parsed from and record its size, modified time
+        # and content hash.  The python version is part of the path as marshal isn't portable between them.
+        self.cache_path = os.path.join(cache_path, 'py%d%d' % sys.version_info[:2])
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry_path(self, filepath, interned):
+        key = '%s:%d' % (os.path.normcase(filepath), interned)
+        return os.path.join(self.cache_path, '%s.bin' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def read_entry(self, entry_path):
+        try:
+            entry = marshal.loads(open(entry_path, 'rb').read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, tuple) or len(entry) != 6 or entry[0] != CACHE_VERSION:
+            return None
+        return entry
+
+    def load(self, filepath, interned=False):
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        entry_path = self.get_entry_path(filepath, interned)
+        entry = self.read_entry(entry_path)
+        if entry and entry[1] != filepath:
+            entry = None
+
+        # Unchanged size and modified time, the file doesn't need to be read at all
+        if entry and entry[2] == stat.st_size and entry[3] == stat.st_mtime_ns:
+            self.hits += 1
+            self.touch(entry_path)
+            return entry[5]
+
+        # Touched but not modified (ie, checked out again), the content hash still matches
+        raw = open(filepath, 'rb').read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if entry and entry[4] == digest:
+            self.hits += 1
+            data = entry[5]
+        else:
+            self.misses += 1
+            data = serializer.loads(raw, interned=interned)
+        self.save_entry(entry_path, (CACHE_VERSION, filepath, stat.st_size, stat.st_mtime_ns, digest, data))
+        return data
+
+    def save_entry(self, entry_path, entry):
+        try:
+            write_if_changed(entry_path, marshal.dumps(entry))
+        except (OSError, ValueError) as e:
+            # The cache is only an optimisation, builds carry on without it
+            logger.warning("Could not write parse cache entry: %s (%s)", entry_path, e)
+
+    def touch(self, entry_path):
+        # Entries are evicted least recently used first, going by their modified time
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    def prune(self):
+        # Evict the least recently used entries until the cache fits within its size cap
+        if not os.path.isdir(self.cache_path):
+            return 0
+        entries = []
+        for entry in os.scandir(self.cache_path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for mtime, size, entry_path in entries)
+        evicted = 0
+        for mtime, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info("Evicted %d entries from the parse cache: %s", evicted, self.cache_path)
+        return evicted
@@ -1,14 +1,23 @@
 import os
 import re
-import json
 import copy
+import hashlib
 
 from .vam.atom import Atom
+from .template import TemplateRegistry
+from . import serializer
 
 import logging
 
+logger = logging.getLogger(__name__)
+
 NAME_PREFIX = 'D'
 
+# Templates rendered for scenes with dialog, every scene is prefilled with the dialog atoms rendered
+# from the atom templates
+ATOM_TEMPLATES = ['dialog', 'dialog_branch', 'dialog_choice']
+TEMPLATES = ATOM_TEMPLATES + ['trigger']
+
 DEFAULT_START_TIME = 0.1
 DEFAULT_DURATION = 3.0
 DEFAULT_MESSAGE_BUFFER = 0.4
@@ -65,133 +74,218 @@ CHOICE_COLORS = {
 }
 
 
-class Dialog(object):
-    branch_idx = 0
-    branch_count_max = 0
-    choice_count_max = 0
-    processed_passages = dict()
+# Loaded dialogs keyed by templates path and dialog path, along with a hash of the dialog's content
+_dialogs = {}
+
+
+class DialogNode(object):
+    def __init__(self, name, tags, target, receiver, duration, prompt, content, links):
+        self.name = name
+        self.tags = tags
+        self.target = target
+        self.receiver = receiver
+        self.duration = duration
+        self.prompt = prompt
+        self.content = content
+        self.links = links
+
 
-    def __init__(self, templates_path, dialog_file):
+class Dialog(object):
+    def __init__(self, templates_path, dialog_file, data=None):
+        # Templates are given as a directory or a template registry, dialog_file names the dialog
+        # in logs and is only read when data isn't given
         self.templates_path = templates_path
-        if not os.path.isdir(self.templates_path):
-            raise FileNotFoundError("Template directory not found!")
+        self.templates = TemplateRegistry.get_registry(self.templates_path)
 
-        self.data = json.load(open(dialog_file, 'r'))
+        self.data = data if data is not None else serializer.load(dialog_file)
         passages = self.data.get('passages')
         self.starting_passage = passages[0]
         self.passages = {x.get('name'): x for x in passages[1:]} if len(passages) > 1 else {}
-        logging.info("Dialog loaded with %d passages: %s" % (len(self.passages), dialog_file))
+        logger.info("Dialog loaded with %d passages: %s", len(self.passages), dialog_file)
+
+        # Compiled passage nodes and branch timelines, filled in by compile() and compile_timelines()
+        self.nodes = dict()
+        self.branches = None
+        self.branch_ids = dict()
+        self.timelines = None
+        self.branch_count_max = 0
+        self.choice_count_max = 0
+        # Filled in by analyzer.analyze
+        self.analysis = None
+
+    @staticmethod
+    def load(templates_path, dialog_file):
+        # Dialogs are shared by every scene (and project) using the same file, until its content changes
+        raw = open(dialog_file, 'rb').read()
+        digest = hashlib.sha1(raw).hexdigest()
+        key = (templates_path, os.path.abspath(dialog_file))
+        cached = _dialogs.get(key)
+        if cached and cached[0] == digest:
+            return cached[1]
+        dialog = Dialog(templates_path, dialog_file, serializer.loads(raw))
+        _dialogs.update({key: (digest, dialog)})
+        return dialog
 
     @staticmethod
     def scaffold_containers(templates_path):
-        template = open(os.path.join(templates_path, 'dialog.json'), 'r').read() \
-            .replace('$ID', ATOM_DIALOG)
-        return {x.get('id'): Atom(x) for x in json.loads(template)}
+        atoms = TemplateRegistry.get_registry(templates_path).render_shared('dialog', ID=ATOM_DIALOG)
+        return {x.get('id'): Atom(x, shared=True) for x in atoms}
 
     @staticmethod
     def scaffold_branch(templates_path, index):
         # Create dialog branch from template
         atom_id = '%s#%d' % (ATOM_BRANCH, index + 1)
-        template = open(os.path.join(templates_path, 'dialog_branch.json'), 'r').read() \
-            .replace('$ID', atom_id)
-        return {x.get('id'): Atom(x) for x in json.loads(template)}
+        atoms = TemplateRegistry.get_registry(templates_path).render_shared('dialog_branch', ID=atom_id)
+        return {x.get('id'): Atom(x, shared=True) for x in atoms}
 
     @staticmethod
     def scaffold_choice(templates_path, index):
         # Create dialog choice from template
         position = CHOICE_STARTING_Y - CHOICE_GAP * index
         atom_id = '%s#%d' % (ATOM_CHOICE, index + 1)
-        template = open(os.path.join(templates_path, 'dialog_choice.json'), 'r').read() \
-            .replace('$ID', atom_id).replace('$POSITION', '%s' % str(position))
-        return {x.get('id'): Atom(x) for x in json.loads(template)}
+        atoms = TemplateRegistry.get_registry(templates_path).render_shared('dialog_choice', ID=atom_id,
+                                                                             POSITION=position)
+        return {x.get('id'): Atom(x, shared=True) for x in atoms}
+
+    def get_node(self, passage):
+        # Parse each passage once into a node with its tags, cleaned text and links resolved
+        name = passage.get('name')
+        node = self.nodes.get(name)
+        if node:
+            return node
+        tags = passage.get('tags', [])
+        try:
+            target, receiver, duration, prompt = self.parse_tags(tags)
+        except Exception:
+            raise Exception("Malformed tags in passage '%s'" % name)
+        links = self.fix_links(passage.get('links', []))
+        content = re.sub(r'\[\[[^\]]+\]\]', '', passage.get('text')).strip()
+        node = DialogNode(name, tags, target, receiver, duration, prompt, content, links)
+        self.nodes.update({name: node})
+        return node
+
+    def follow(self, node, link):
+        passage = self.passages.get(link.get('link'))
+        if not passage:
+            raise Exception("Passage '%s' links to missing passage '%s'" % (node.name, link.get('link')))
+        return self.get_node(passage)
+
+    def compile(self):
+        # Walk the passage graph once with an explicit stack.  Each branch is a chain of passages
+        # followed through their first link until a prompt (whose links start new branches) or a
+        # dead end.  Branches are numbered in the same depth first order they are linked in.
+        if self.branches is not None:
+            return self.branches
+        self.branches = list()
+        self.branch_ids = dict()
+        self.choice_count_max = 0
+        stack = [self.get_node(self.starting_passage)]
+        while stack:
+            node = stack.pop()
+            if node.name in self.branch_ids:
+                continue
+            branch_id = '%s#%d' % (ATOM_BRANCH, len(self.branches) + 1)
+            self.branch_ids.update({node.name: branch_id})
+
+            steps = list()
+            chain = set()
+            start_time = DEFAULT_START_TIME
+            while True:
+                if node.name in chain:
+                    raise Exception("Dialog loops back to passage '%s' without a prompt" % node.name)
+                chain.add(node.name)
+                steps.append((node, start_time))
+                end_time = start_time + node.duration + DEFAULT_MESSAGE_BUFFER
+                if not node.links:
+                    break
+                if node.prompt:
+                    if self.choice_count_max < len(node.links):
+                        self.choice_count_max = len(node.links)
+                    stack += [self.follow(node, link) for link in reversed(node.links)]
+                    break
+                # Only follow first link for non-prompting dialogs
+                node = self.follow(node, node.links[0])
+                start_time = end_time
+
+            self.branches.append((branch_id, steps, end_time))
+
+        self.branch_count_max = len(self.branches)
+        return self.branches
+
+    def compile_timelines(self):
+        # Timings and dialog actions for every trigger.  These don't depend on the scene, so are
+        # compiled once and merged with each scene's own (non-dialog) actions when building.
+        if self.timelines is not None:
+            return self.timelines
+        self.timelines = list()
+        # Passages and links are only logged when debugging, checked once as there can be thousands
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for branch_id, steps, total_time in self.compile():
+            if debug:
+                logger.debug("Compiling dialog branch: %s", steps[0][0].name)
+            triggers = list()
+            for node, start_time in steps:
+                trigger_name = '%s:%s' % (NAME_PREFIX, node.name)
+                if debug:
+                    logger.debug("[%s] %s: \"%s\"", trigger_name, ' '.join(node.tags), node.content)
+
+                # Figure out start and end times
+                end_time = start_time + node.duration + DEFAULT_MESSAGE_BUFFER
+                times = (str(start_time), str(start_time + DEFAULT_PROMPT_BUFFER) if node.prompt else str(end_time))
+
+                # Create actions for the message bubble
+                actions = list()
+                if node.target and node.receiver:
+                    actions += self.get_bubble_actions(node.target, node.receiver, node.content, node.duration)
+
+                # Create actions to set dialog buttons
+                if len(node.links) == 0:
+                    actions += self.get_restart_actions()
+                elif node.prompt:
+                    if debug:
+                        logger.debug("Found dialog prompt with %d responses.", len(node.links))
+                    actions += self.get_prompt_actions()
+                    for link_idx, link in enumerate(node.links):
+                        if debug:
+                            logger.debug("[%s] %s: %s -> %s", trigger_name, link['color'], link['safe_name'],
+                                         link['link'])
+                        link_branch_id = self.branch_ids.get(link.get('link'))
+                        actions += self.get_button_actions(link, link_idx, link_branch_id)
+
+                triggers.append((trigger_name, start_time == DEFAULT_START_TIME, times, actions))
+            self.timelines.append((branch_id, triggers, str(total_time)))
+        return self.timelines
 
     def build(self, scene):
-        self.branch_idx = 0
-        self.processed_passages = dict()
-        self.build_branch(scene, self.starting_passage)
-
-    def build_branch(self, scene, passage):
-        existing_branch_id = self.processed_passages.get(passage.get('name'))
-        if existing_branch_id:
-            return existing_branch_id
-        logging.info("Building dialog branch: %s" % passage.get('name'))
-        self.branch_idx += 1
-        branch_id = '%s#%d' % (ATOM_BRANCH, self.branch_idx)
-        self.processed_passages.update({passage.get('name'): branch_id})
-        branch_atom = scene.atoms.get(branch_id)
-        branch_duration_atom = scene.atoms.get('%s-Duration' % branch_id)
-        animation_pattern = branch_atom.storables.get('AnimationPattern')
-        existing_triggers = copy.deepcopy(animation_pattern.data['triggers'])
-        existing_triggers = {x.get('displayName'): x for x in existing_triggers}
-        new_triggers, total_time = self.build_trigger(scene, passage, existing_triggers)
-        animation_pattern.data['triggers'] = new_triggers
-        branch_duration_atom.storables.get('Step').data['transitionToTime'] = str(total_time)
-        return branch_id
-
-    def build_trigger(self, scene, passage, existing_triggers, start_time=DEFAULT_START_TIME):
-        triggers = list()
-        trigger_name = '%s:%s' % (NAME_PREFIX, passage.get('name'))
+        # Returns the number of atoms written, each branch's atom and its duration atom
+        atoms = 0
+        for branch_id, triggers, total_time in self.compile_timelines():
+            branch_atom = scene.atoms.get(branch_id)
+            branch_duration_atom = scene.atoms.get('%s-Duration' % branch_id)
+            animation_pattern = branch_atom.storables.get('AnimationPattern')
+            existing_triggers = {x.get('displayName'): x for x in animation_pattern.data['triggers']}
+            animation_pattern.data['triggers'] = [self.build_trigger(trigger, existing_triggers) for trigger in triggers]
+            branch_duration_atom.storables.get('Step').data['transitionToTime'] = total_time
+            atoms += 2
+        return atoms
+
+    def build_trigger(self, compiled_trigger, existing_triggers):
+        trigger_name, first, times, dialog_actions = compiled_trigger
         if trigger_name not in existing_triggers.keys():
-            trigger = json.load(open(os.path.join(self.templates_path, 'trigger.json'), 'r'))
+            trigger = self.templates.render('trigger')
             trigger['displayName'] = trigger_name
         else:
             trigger = existing_triggers.pop(trigger_name)
 
         # Strip all dialog actions, but keep others found
         actions = list()
-        if start_time == DEFAULT_START_TIME:
+        if first:
             actions += self.get_hide_choices_actions()
         actions += [x for x in trigger.get('startActions') if not x.get('name', '').startswith('%s:' % NAME_PREFIX)]
-        trigger['startActions'] = actions
-
-        # Determine flow based on tags
-        tags = passage.get('tags', [])
-        try:
-            target, receiver, duration, prompt = self.parse_tags(tags)
-        except Exception:
-            raise Exception("Malformed tags in passage '%s'" % passage.get('name'))
-
-        # Clean message content
-        links = self.fix_links(passage.get('links', []))
-        content = re.sub(r'\[\[[^\]]+\]\]', '', passage.get('text')).strip()
-
-        logging.info("[%s] %s: \"%s\"" % (trigger_name, ' '.join(tags), content))
-
-        # Figure out start and end times
-        end_time = start_time + duration + DEFAULT_MESSAGE_BUFFER
-        trigger['startTime'] = str(start_time)
-        trigger['endTime'] = str(start_time + DEFAULT_PROMPT_BUFFER) if prompt else str(end_time)
-
-        # Create actions and add to trigger
-        if target and receiver:
-            trigger['startActions'] += self.get_bubble_actions(target, receiver, content, duration)
-
-        # Create actions to set dialog buttons
-        if len(links) == 0:
-            trigger['startActions'] += self.get_restart_actions()
-        elif prompt:
-            logging.info("Found dialog prompt with %d responses." % len(links))
-            trigger['startActions'] += self.get_prompt_actions()
-            for link in links:
-                logging.info("[%s] %s: %s -> %s" % (trigger_name, link['color'], link['safe_name'], link['link']))
-
-        # Append trigger to list
-        triggers.append(trigger)
-
-        # Follow links to create complete timeline out of triggers
-        for link_idx, link in enumerate(links):
-            link_id = link.get('link')
-            follow_passage = self.passages.get(link_id)
-            if prompt:
-                branch_id = self.build_branch(scene, follow_passage)
-                trigger['startActions'] += self.get_button_actions(link, link_idx, branch_id)
-            else:
-                # Only follow first link for non-prompting dialogs
-                child_triggers, end_time = self.build_trigger(scene, follow_passage, existing_triggers, end_time)
-                triggers += child_triggers
-                break
-
-        return triggers, end_time
+        # Compiled actions are cached on the dialog and shared by every scene using it, each scene gets a copy
+        trigger['startActions'] = actions + copy.deepcopy(dialog_actions)
+        trigger['startTime'], trigger['endTime'] = times
+        return trigger
 
     def get_hide_choices_actions(self):
         actions = list()
@@ -292,42 +386,14 @@ class Dialog(object):
         })
         return actions
 
-    def get_atom_counts(self, passage=None):
-        branch_count = 0
-        choice_count = 0
-        if not passage:
-            self.processed_passages = dict()
-            passage = self.starting_passage
-            branch_count += 1
-        elif passage.get('name') in self.processed_passages.keys():
-            return 0, 0
-
-        self.processed_passages.update({passage.get('name'): ''})
-        tags = passage.get('tags', [])
-        links = self.fix_links(passage.get('links', []))
-
-        try:
-            target, receiver, duration, prompt = self.parse_tags(tags)
-        except Exception:
-            raise Exception("Malformed tags in passage '%s'" % passage.get('name'))
-
-        if prompt and len(links) > choice_count:
-            choice_count = len(links)
-
-        for link in links:
-            if prompt:
-                branch_count += 1
-            atom_counts = self.get_atom_counts(self.passages.get(link.get('link')))
-            branch_count += atom_counts[0]
-            if atom_counts[1] > choice_count:
-                choice_count = atom_counts[1]
-
-        self.branch_count_max = branch_count
-        self.choice_count_max = choice_count
-        return branch_count, choice_count
+    def get_atom_counts(self):
+        self.compile()
+        return self.branch_count_max, self.choice_count_max
 
     def fix_links(self, links):
+        fixed_links = list()
         for link in links:
+            link = dict(link)
             link['link'] = link.get('link').split('|')[-1].split('<-')[0]
             link['name'] = link.get('name').split('|')[0].split('<-')[-1]
             link['safe_name'] = link.get('name')
@@ -337,7 +403,8 @@ class Dialog(object):
                     link['safe_name'] = link.get('name')[len(color_name) + 1:]
                     link['color'] = color_name.upper()
                     break
-        return links
+            fixed_links.append(link)
+        return fixed_links
 
     def parse_tags(self, tags):
         target = ''
@@ -0,0 +1,22 @@
+import os
+
+
+def normalize_path(filepath):
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+class DependencyGraph(object):
+    def __init__(self):
+        # Links each file back to the nodes (ie, scenes) built from it
+        self.dependents = {}
+
+    def add(self, node, filepath):
+        filepath = normalize_path(filepath)
+        self.dependents.setdefault(filepath, set()).add(node)
+
+    def get_dependents(self, *filepaths):
+        # Every node built from any of the given files
+        dependents = set()
+        for filepath in filepaths:
+            dependents |= self.dependents.get(normalize_path(filepath), set())
+        return dependents
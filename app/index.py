@@ -0,0 +1,74 @@
+import sys
+
+
+def get_prefix(atom_id):
+    # Atom ids are suffixed with a count when duplicated, ie. 'Girl#2' has the prefix 'Girl'
+    return atom_id.split('#')[0]
+
+
+class AtomIndex(object):
+    def __init__(self, scenes=None):
+        # Every atom id is interned and given a bit, each scene records the atoms it contains as a
+        # bitmap so presence, backfill and compatibility checks are integer operations
+        self.bits = {}
+        self.scenes = {}
+        self.owners = {}
+        self.prefixes = {}
+        for scene_path, scene in (scenes or {}).items():
+            self.add_scene(scene_path, scene)
+
+    def add_scene(self, scene_path, scene):
+        self.add_ids(scene_path, scene.atoms.keys())
+
+    def add_ids(self, scene_path, atom_ids):
+        # Scenes can also be indexed by their atom ids alone, ie. as recorded by the last build
+        mask = 0
+        for atom_id in atom_ids:
+            mask |= self.add_atom(atom_id)
+            # The last scene to contain an atom is the one it's backfilled from
+            self.owners[atom_id] = scene_path
+        self.scenes[scene_path] = self.scenes.get(scene_path, 0) | mask
+
+    def add_atom(self, atom_id):
+        bit = self.bits.get(atom_id)
+        if bit is None:
+            atom_id = sys.intern(atom_id)
+            bit = 1 << len(self.bits)
+            self.bits[atom_id] = bit
+            prefix = get_prefix(atom_id)
+            self.prefixes[prefix] = self.prefixes.get(prefix, 0) | bit
+        return bit
+
+    def get_mask(self, atom_ids):
+        mask = 0
+        for atom_id in atom_ids:
+            mask |= self.bits.get(atom_id, 0)
+        return mask
+
+    def get_ids(self, mask):
+        # Atom ids in the order they were first seen
+        return [atom_id for atom_id, bit in self.bits.items() if mask & bit]
+
+    @property
+    def all(self):
+        return (1 << len(self.bits)) - 1
+
+    def get_prefix_mask(self, *prefixes):
+        mask = 0
+        for prefix in prefixes:
+            mask |= self.prefixes.get(prefix, 0)
+        return mask
+
+    def get_owner(self, atom_id):
+        return self.owners.get(atom_id)
+
+    def get_missing(self, scene_path, mask=None):
+        # Atoms in mask (by default every atom in the project) that the scene doesn't contain
+        mask = self.all if mask is None else mask
+        return mask & ~self.scenes.get(scene_path, 0)
+
+    def get_difference(self, from_scene_path, to_scene_path):
+        # Atoms that merge-loading to_scene over from_scene would have to add and leave behind
+        from_mask = self.scenes.get(from_scene_path, 0)
+        to_mask = self.scenes.get(to_scene_path, 0)
+        return to_mask & ~from_mask, from_mask & ~to_mask
@@ -0,0 +1,130 @@
+import json
+import queue
+import logging
+
+from logging.handlers import QueueHandler, QueueListener
+
+# Every module logs through its own logger (logging.getLogger(__name__)), subsystems are named after
+# the module, ie. 'dialog' for app.dialog.  The default level applies to everything not given its own.
+ROOT_LOGGER = 'app'
+DEFAULT_LEVEL = 'INFO'
+
+FORMAT_TEXT = 'text'
+FORMAT_JSON = 'json'
+FORMATS = [FORMAT_TEXT, FORMAT_JSON]
+TEXT_FORMAT = '%(process)d - %(levelname)s - %(name)s - %(message)s'
+
+# Levels set in this process by subsystem, worker processes are given their parent's (see init_worker_logging)
+_levels = {}
+
+
+def get_logger(subsystem):
+    # Logger for code outside the app package (ie, 'build' for build.py), filtered like app modules
+    return logging.getLogger('%s.%s' % (ROOT_LOGGER, subsystem))
+
+
+def get_fields(record):
+    # Structured fields of a record, logged as a single dict argument (ie, "Saved %(path)s", {'path': ..})
+    fields = getattr(record, 'fields', None)
+    if fields is None and isinstance(record.args, dict):
+        fields = record.args
+    return fields or {}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            'time': record.created,
+            'process': record.process,
+            'level': record.levelname,
+            'subsystem': record.name,
+            'message': record.getMessage()
+        }
+        event.update({key: value for key, value in get_fields(record).items() if key not in event})
+        if record.exc_info:
+            event.update({'exception': self.formatException(record.exc_info)})
+        return json.dumps(event, default=str)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    # Records are queued as they are and only formatted by the background writer, so messages that
+    # are never written (or written later) cost the logging thread next to nothing.  Arguments must
+    # not be changed after they are logged.
+    def prepare(self, record):
+        return record
+
+
+class WorkerQueueHandler(QueueHandler):
+    # Records sent from worker processes are formatted before they are pickled, structured fields
+    # are kept alongside the message
+    def prepare(self, record):
+        fields = get_fields(record)
+        record = super().prepare(record)
+        record.fields = fields
+        return record
+
+
+def parse_levels(values):
+    # Levels given as LEVEL (the default level) or SUBSYSTEM=LEVEL (ie, dialog=DEBUG)
+    levels = {}
+    for value in values or []:
+        subsystem, level = value.split('=', 1) if '=' in value else ('', value)
+        levels.update({subsystem.strip(): level.strip().upper()})
+    return levels
+
+
+def set_levels(levels):
+    levels = dict(levels or {})
+    for subsystem, level in levels.items():
+        if not isinstance(logging.getLevelName(level), int):
+            raise Exception("Invalid log level: %s" % level)
+    _levels.clear()
+    _levels.update(levels)
+    apply_levels()
+
+
+def get_levels():
+    levels = {'': DEFAULT_LEVEL}
+    levels.update(_levels)
+    return levels
+
+
+def apply_levels():
+    # The default level is set on the root logger, so modules outside the app (ie, build.py) follow it
+    for subsystem, level in get_levels().items():
+        name = '%s.%s' % (ROOT_LOGGER, subsystem) if subsystem else None
+        logging.getLogger(name).setLevel(level)
+
+
+def get_formatter(log_format=FORMAT_TEXT):
+    if log_format not in FORMATS:
+        raise Exception("Invalid log format: %s" % log_format)
+    return JsonFormatter() if log_format == FORMAT_JSON else logging.Formatter(TEXT_FORMAT)
+
+
+def start_logging(filepath, levels=None, log_format=FORMAT_TEXT):
+    # Records are handed to a background thread that formats and writes them, returns the listener
+    # to pass to stop_logging once done
+    formatter = get_formatter(log_format)
+    set_levels(levels)
+    handler = logging.FileHandler(filepath, mode='a', encoding='utf-8')
+    handler.setFormatter(formatter)
+    log_queue = queue.Queue()
+    logging.getLogger().handlers = [BackgroundQueueHandler(log_queue)]
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop_logging(listener):
+    # Writes out everything still queued
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+def init_worker_logging(log_queue, levels=None):
+    # Route all worker logging through the parent so output.log stays coherent, at the parent's levels
+    logger = logging.getLogger()
+    logger.handlers = [WorkerQueueHandler(log_queue)]
+    set_levels(levels)
@@ -0,0 +1,102 @@
+import os
+import hashlib
+
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 3
+
+
+def hash_file(filepath):
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_data(data):
+    return hashlib.sha1(serializer.dumps(data, pretty=True)).hexdigest()
+
+
+class Manifest(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.data = {}
+        if os.path.isfile(self.filepath):
+            try:
+                self.data = serializer.load(self.filepath)
+            except ValueError:
+                logger.warning("Ignoring corrupt build manifest: %s", self.filepath)
+        if self.data.get('version') != MANIFEST_VERSION:
+            self.data = {}
+
+    @property
+    def inputs(self):
+        return self.data.get('inputs', {})
+
+    @property
+    def shared(self):
+        return self.data.get('shared')
+
+    @property
+    def scenes(self):
+        return self.data.get('scenes', {})
+
+    @property
+    def dialog_atoms(self):
+        return self.data.get('dialog_atoms')
+
+    def is_built(self, scene_path, inputs, shared):
+        # Whether the scene was last built from the same inputs and shared atoms
+        built = self.scenes.get(scene_path, {}).get('built')
+        return built == {
+            'global': hash_data(inputs.get('global', {})),
+            'scene': inputs.get('scenes', {}).get(scene_path),
+            'shared': shared
+        }
+
+    def get_atom_ids(self, scene_path, source):
+        # Atom ids found in the source scene, as long as the source (the hash of the scene, or of the
+        # template scenes without one start from) hasn't changed since they were recorded
+        atoms = self.scenes.get(scene_path, {}).get('atoms')
+        if not atoms or atoms.get('source') != source:
+            return None
+        return atoms.get('ids')
+
+    def get_all_atom_ids(self):
+        # Atom ids of every scene as of the last build, whether or not they've changed since
+        return {scene_path: scene['atoms']['ids'] for scene_path, scene in self.scenes.items() if scene.get('atoms')}
+
+    def update(self, inputs, shared, built_scene_paths, atom_ids, atom_sources, dialog_atom_ids):
+        # Scenes that weren't built this time keep their previous record until they are
+        scenes = {}
+        for scene_path, scene_inputs in inputs.get('scenes', {}).items():
+            scene = dict(self.scenes.get(scene_path, {}))
+            if scene_path in built_scene_paths:
+                scene.update({'built': {
+                    'global': hash_data(inputs.get('global', {})),
+                    'scene': scene_inputs,
+                    'shared': shared
+                }})
+            if scene_path in atom_ids:
+                scene.update({'atoms': {'source': atom_sources[scene_path], 'ids': list(atom_ids[scene_path])}})
+            scenes.update({scene_path: scene})
+        self.data = {
+            'version': MANIFEST_VERSION,
+            'inputs': inputs,
+            'shared': shared,
+            'dialog_atoms': sorted(dialog_atom_ids),
+            'scenes': scenes
+        }
+
+    def save(self):
+        serializer.dump(self.data, self.filepath, pretty=True)
+
+    def delete(self):
+        if os.path.isfile(self.filepath):
+            os.remove(self.filepath)
+        self.data = {}
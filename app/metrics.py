@@ -0,0 +1,178 @@
+import sys
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+from contextlib import contextmanager
+
+from . import serializer
+from . import cache
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+TOP_ALLOCATIONS = 25
+
+
+def get_peak_rss():
+    # Peak resident memory of this process over its whole lifetime (a high-water mark, not the peak of
+    # any one phase) in bytes, or None if it can't be determined
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    return None
+
+
+def get_cache_counts():
+    # Hits and misses of this process's parse cache so far, None without one
+    parse_cache = cache.get_cache()
+    return (parse_cache.hits, parse_cache.misses) if parse_cache else None
+
+
+def count_atoms(atoms):
+    return len(atoms), sum(atom.get_storable_count() for atom in atoms.values())
+
+
+class Metrics(object):
+    def __init__(self, name, profile=False):
+        self.name = name
+        self.profile = profile
+        self.phases = list()
+        self.profiler = None
+        # Profile stats handed back by scene workers, merged into the profile when it's saved
+        self.worker_stats = list()
+        self.allocations = list()
+        # Reports of what the build did besides its phases (ie, stub backfill savings), by name
+        self.reports = dict()
+        self.started = None
+        self.cache_counts = None
+        self.total = None
+
+    def __getstate__(self):
+        # Profilers can't be pickled, scene workers profile their own work (see collect)
+        state = dict(self.__dict__)
+        state.update({'profiler': None, 'phases': [], 'worker_stats': [], 'allocations': [], 'reports': {}})
+        return state
+
+    def start(self):
+        if self.profile:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.started = (time.perf_counter(), time.process_time())
+        self.cache_counts = get_cache_counts()
+
+    def stop(self):
+        self.total = {
+            'wall_time': time.perf_counter() - self.started[0],
+            'cpu_time': time.process_time() - self.started[1],
+            'process_peak_rss': get_peak_rss()
+        }
+        # Files parsed during the build that were (or weren't) found in the parse cache
+        cache_counts = get_cache_counts()
+        if cache_counts:
+            started = self.cache_counts or (0, 0)
+            parse_cache = {'hits': cache_counts[0] - started[0], 'misses': cache_counts[1] - started[1]}
+            self.add_report('parse_cache', parse_cache)
+            logger.info("Parse cache: %(hits)d hits, %(misses)d misses", parse_cache)
+        if self.profile:
+            self.profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            self.total.update({'traced_peak': tracemalloc.get_traced_memory()[1]})
+            tracemalloc.stop()
+            self.allocations = [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                                for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]]
+
+    @contextmanager
+    def phase(self, name):
+        # Callers fill in the atoms, storables and bytes processed on the yielded record
+        record = {'name': name, 'atoms': 0, 'storables': 0, 'bytes': 0}
+        if self.profile and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        wall_time, cpu_time = time.perf_counter(), time.process_time()
+        peak_rss = get_peak_rss()
+        try:
+            yield record
+        finally:
+            # The process high-water mark after the phase, and how far the phase raised it
+            process_peak_rss = get_peak_rss()
+            record.update({
+                'wall_time': time.perf_counter() - wall_time,
+                'cpu_time': time.process_time() - cpu_time,
+                'process_peak_rss': process_peak_rss,
+                'peak_rss_growth': process_peak_rss - peak_rss if peak_rss is not None else None
+            })
+            if self.profile:
+                record.update({'traced_peak': tracemalloc.get_traced_memory()[1]})
+            self.phases.append(record)
+            # Phases summarize the work logged item by item at debug level
+            counts = ''.join(', %%(%s)d %s' % (key, key) for key in ['atoms', 'storables', 'bytes'] if record[key])
+            logger.info("Phase %(phase)s took %(wall_time).3fs (%(cpu_time).3fs cpu)" + counts,
+                        dict(record, phase=name))
+
+    def collect(self, work, *args):
+        # Run work in a scene worker, returning its result along with the phases it recorded and (when
+        # profiling) its profile stats, for the parent to merge
+        self.phases = []
+        profiler = None
+        if self.profile:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            result = work(*args)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.create_stats()
+        return result, self.phases, profiler.stats if profiler else None
+
+    def merge(self, phases, stats=None):
+        # Phases and profile stats collected by a scene worker
+        self.phases += phases
+        if stats:
+            self.worker_stats.append(stats)
+
+    def get_stats(self):
+        stats = pstats.Stats(self.profiler)
+        for worker_stats in self.worker_stats:
+            worker = pstats.Stats()
+            worker.stats = worker_stats
+            worker.get_top_level_stats()
+            stats.add(worker)
+        return stats
+
+    def add_report(self, name, data):
+        self.reports.update({name: data})
+
+    def report(self):
+        report = {
+            'project': self.name,
+            'total': self.total,
+            'phases': self.phases
+        }
+        report.update(self.reports)
+        if self.profile:
+            report.update({'allocations': self.allocations})
+        return report
+
+    def save(self, filepath, profile_filepath=None):
+        serializer.dump(self.report(), filepath, pretty=True)
+        if self.profiler and profile_filepath:
+            self.get_stats().dump_stats(profile_filepath)
@@ -0,0 +1,66 @@
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from logging.handlers import QueueListener
+
+from .log import init_worker_logging, get_levels
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Shared state for scene workers, set once per worker process by init_scene_worker
+_worker_state = {}
+
+
+def init_scene_worker(log_queue, levels, json_backend, project, backfill_atoms, package_atoms):
+    init_worker_logging(log_queue, levels)
+    serializer.set_backend(json_backend)
+    _worker_state.update({
+        'project': project,
+        'backfill_atoms': backfill_atoms,
+        'package_atoms': package_atoms
+    })
+
+
+def scaffold_scene(scene_path, scene):
+    # Phases recorded by the worker are returned with the scene, so the build's metrics are the same
+    # whether or not scenes were built by workers
+    project = _worker_state['project']
+    result, phases, stats = project.metrics.collect(project.scaffold_scenes, {scene_path: scene},
+                                                    _worker_state['backfill_atoms'], _worker_state['package_atoms'])
+    total_bytes, scene_weights = result
+    return scene_path, total_bytes, scene_weights, phases, stats
+
+
+class ScenePipeline(object):
+    def __init__(self, project, workers):
+        self.project = project
+        self.workers = workers
+
+    def run(self, scenes, backfill_atoms, package_atoms):
+        # Shared atoms are sent to each worker once, scenes are streamed through as independent jobs.
+        # Returns the bytes written along with the weights of each scene, if the project is weighing them.
+        # Each worker's phases and profile are merged into the project's metrics.
+        logger.info("Scaffolding %d scenes with %d workers.", len(scenes), self.workers)
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+        total_bytes = 0
+        scene_weights = {}
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(scenes)),
+                                     initializer=init_scene_worker,
+                                     initargs=(log_queue, get_levels(), serializer.get_backend(), self.project,
+                                               backfill_atoms, package_atoms)) as executor:
+                futures = [executor.submit(scaffold_scene, scene_path, scene) for scene_path, scene in scenes.items()]
+                for future in as_completed(futures):
+                    scene_path, scene_bytes, weights, phases, stats = future.result()
+                    total_bytes += scene_bytes
+                    scene_weights.update(weights)
+                    self.project.metrics.merge(phases, stats)
+                    logger.debug("Scene scaffolded: %s", scene_path)
+        finally:
+            listener.stop()
+        return total_bytes, scene_weights
@@ -1,26 +1,43 @@
 import os
-import json
-import copy
-import shutil
-import pathlib
 
-from glob import glob
+from fnmatch import fnmatch
 
 from .vam.scene import Scene
-from .vam.atom import Atom
-from .dialog import Dialog
+from .dialog import Dialog, TEMPLATES as DIALOG_TEMPLATES, ATOM_TEMPLATES as DIALOG_ATOM_TEMPLATES
+from .graph import DependencyGraph
+from .scaffold import Scaffold, SOURCE_DIALOG
+from .sinks import DirectorySink, VarSink, DEFAULT_COMPRESSION
+from .manifest import Manifest, hash_file, hash_data
+from .sync import sync_tree, prune_tree
+from .transitions import Transitions
+from .weights import Weights
+from .metrics import count_atoms
+from . import serializer
 
 import logging
 
-IGNORE_ATOMS = ['AnimationStep']
-
-
-class Project(object):
-    dialog_branch_count_max = 0
-    dialog_choice_count_max = 0
-
-    def __init__(self, name, projects_path, templates_path, scenes_path):
-        self.name = name
+logger = logging.getLogger(__name__)
+
+# Package details used for .var packages, overridden by 'var' in the blueprint
+DEFAULT_VAR_CONFIG = {
+    'creator': 'VSB',
+    'version': 1,
+    'license': 'FC',
+    'description': ''
+}
+
+
+class Project(Scaffold):
+    def __init__(self, name, projects_path, templates_path, scenes_path, workers=1, profile=False, cache=None,
+                 transitions=False, weights=False, low_memory=False, check=False, package_path=None,
+                 compression=DEFAULT_COMPRESSION):
+        # Builds a project from its blueprint, templates and scenes on disk, see Scaffold for the build itself.
+        # Given a package path, the project is written there as a single .var package instead of loose files.
+        self.transitions = transitions
+        # Low memory builds hold a single scene at a time, see build_scenes_low_memory
+        self.low_memory = low_memory
+        # Parsed packages, scenes and dialogs, kept between builds of the same project in watch mode
+        self.cache = cache if cache is not None else {}
 
         self.projects_path = projects_path
         if not os.path.isdir(self.projects_path):
@@ -38,168 +55,443 @@ class Project(object):
         if not os.path.isdir(self.scenes_path):
             raise FileNotFoundError("Packages directory not found!")
 
-        self.build_path = os.path.join(self.scenes_path, "%s.scaffold" % self.name)
-        self.source_path = os.path.join(self.scenes_path, self.name)
-
-        config_filepath = os.path.join(self.projects_path, self.name, 'blueprint.json')
-        self.config = json.load(open(config_filepath, 'r'))
-
-    def scaffold(self):
-        # Delete existing build path
-        if os.path.exists(self.build_path):
-            logging.warning("Deleting build path: %s" % self.build_path)
-            shutil.rmtree(self.build_path)
-
-        # Copy source files to build path (if applicable)
-        if os.path.isdir(self.source_path):
-            logging.info("Transferring scene files: %s -> %s" % (self.source_path, self.build_path))
-            shutil.copytree(self.source_path, self.build_path)
-
-        # Get all atoms to pack into scenes
+        self.build_path = os.path.join(self.scenes_path, "%s.scaffold" % name)
+        self.source_path = os.path.join(self.scenes_path, name)
+        self.manifest_path = os.path.join(self.scenes_path, "%s.scaffold.manifest" % name)
+        self.metrics_path = os.path.join(self.scenes_path, "%s.scaffold.metrics" % name)
+        self.profile_path = os.path.join(self.scenes_path, "%s.scaffold.prof" % name)
+        self.transitions_path = os.path.join(self.scenes_path, "%s.scaffold.transitions" % name)
+        self.weights_path = os.path.join(self.scenes_path, "%s.scaffold.weights" % name)
+        self.dialogs_path = os.path.join(self.scenes_path, "%s.scaffold.dialogs" % name)
+
+        config_filepath = os.path.join(self.projects_path, name, 'blueprint.json')
+        config = serializer.load(config_filepath)
+        self.package_path = package_path
+        if self.package_path:
+            if self.transitions:
+                raise Exception("Transition reports are read back from the build path, they can't be made for packages")
+            var_config = self.get_var_config(name, config)
+            self.var_filepath = os.path.join(self.package_path, '%(creator)s.%(name)s.%(version)s.var' % var_config)
+            sink = VarSink(self.var_filepath, 'Saves/scene/%s.scaffold' % name, self.get_var_meta(var_config),
+                           compression, self.low_memory)
+        else:
+            sink = DirectorySink(self.build_path, streaming=self.low_memory)
+        super().__init__(name, config, self.templates_path, workers, profile, weights, sink, check)
+
+    def __getstate__(self):
+        # Scene workers receive the scenes they need, there's no need to ship the cache with them
+        state = dict(self.__dict__)
+        state.update({'cache': {}})
+        return state
+
+    def scaffold(self, force=False, scene_paths=None):
+        # Record per phase metrics for every build, saved alongside the build manifest
+        def build():
+            built = self.scaffold_project(force, scene_paths)
+            if self.transitions:
+                with self.metrics.phase('report_transitions') as phase:
+                    phase['scenes'] = self.report_transitions()
+            return built
+        built = None
+        try:
+            built = self.run(build)
+        finally:
+            # Skipped builds keep the metrics of the last build that ran
+            if built is not False:
+                self.metrics.save(self.metrics_path, self.profile_path)
+
+    def scaffold_project(self, force=False, scene_paths=None):
+        # Returns whether the project was built, False when skipped as up to date
+        manifest = Manifest(self.manifest_path)
+        if force and not self.package_path:
+            # Nothing recorded by the last build is trusted, including the atom ids of unchanged scenes.  Packages
+            # don't record a manifest, the one kept for the build path is left alone.
+            manifest.delete()
+        scene_configs = self.get_scene_configs()
+        # Only the given scenes are built, every scene is still scanned for atoms to backfill.  Packages
+        # are always written whole, with every scene.
+        selected = [x for x in scene_configs.keys() if scene_paths is None or x in scene_paths or self.package_path]
+        with self.metrics.phase('get_inputs') as phase:
+            inputs = self.get_inputs(scene_configs)
+            phase['files'] = len(inputs['global']) + len(inputs['scenes'])
+
+        # Every selected scene is rebuilt when forced or on first build
+        rebuild = force or self.package_path or not os.path.isdir(self.build_path)
+
+        # Mirror source assets into the build path (if applicable) or the package, scenes are written when saved.
+        # Assets aren't build inputs, they're synced (and anything no longer part of the project removed)
+        # even when every scene is up to date.
+        if self.package_path:
+            logger.info("Packing scene files: %s -> %s", self.source_path, self.var_filepath)
+            with self.metrics.phase('pack_assets') as phase:
+                assets = self.sink.add_tree(self.source_path, self.get_scene_file_filter(scene_configs))
+                phase['files'] = len(assets)
+        else:
+            logger.info("Transferring scene files: %s -> %s", self.source_path, self.build_path)
+            with self.metrics.phase('sync_assets') as phase:
+                assets = sync_tree(self.source_path, self.build_path, self.get_scene_file_filter(scene_configs))
+                phase['files'] = len(assets)
+            prune_tree(self.build_path, assets | set(scene_configs.keys()))
+
+        # Skip projects whose inputs all match the last build of the selected scenes
+        if not force and not self.package_path and manifest.inputs == inputs and self.has_outputs(selected) \
+                and all(manifest.is_built(scene_path, inputs, manifest.shared) for scene_path in selected):
+            logger.info("Project is up to date, skipping: %s", self.name)
+            return False
+
+        with self.metrics.phase('load_dialogs'):
+            dialogs = self.load_dialogs(scene_configs)
+        package_atoms, dialog_atoms = self.get_atoms(scene_configs, dialogs)
+
+        atom_ids = self.get_recorded_atom_ids(manifest, inputs, scene_configs.keys())
+        if self.low_memory:
+            # First pass only collects atom ids, scenes are loaded again one at a time when built
+            scenes = {}
+            with self.metrics.phase('scan_scenes') as phase:
+                scanned = self.scan_scenes([x for x in scene_configs.keys() if x not in atom_ids])
+                phase['scenes'] = len(scanned)
+            atom_ids.update(scanned)
+            logger.info("Found %d scenes, %d scanned.", len(scene_configs), len(scanned))
+        else:
+            with self.metrics.phase('load_scenes') as phase:
+                scenes = self.load_scenes([x for x in scene_configs.keys() if x not in atom_ids], dialogs)
+                phase['atoms'], phase['storables'] = self.count_scene_atoms(scenes)
+            atom_ids.update({scene_path: list(scene.atoms.keys()) for scene_path, scene in scenes.items()})
+            logger.info("Found %d scenes, %d loaded.", len(scene_configs), len(scenes))
+        index, backfill_mask = self.index_scenes(scene_configs.keys(), atom_ids, dialog_atoms, package_atoms)
+
+        # Work out which scenes are affected, shared atoms changing invalidates every scene
+        shared = self.get_shared_fingerprint(dialog_atoms, index, backfill_mask, inputs)
+        affected_scene_paths = [scene_path for scene_path in selected
+                                if rebuild or not manifest.is_built(scene_path, inputs, shared)
+                                or not os.path.isfile(self.get_build_scene_path(scene_path))]
+        logger.info("Rebuilding %d of %d scenes.", len(affected_scene_paths), len(scene_configs))
+
+        logger.info("Saving scenes to %s", self.var_filepath if self.package_path else self.build_path)
+        if self.low_memory:
+            scene_weights = self.build_scenes_low_memory(affected_scene_paths, dialogs, dialog_atoms, package_atoms,
+                                                         index, backfill_mask)
+        else:
+            # Load affected scenes along with the scenes owning atoms they are missing
+            missing_mask = self.get_missing_mask(index, affected_scene_paths, backfill_mask)
+            owner_scene_paths = {index.get_owner(atom_id) for atom_id in index.get_ids(missing_mask)}
+            with self.metrics.phase('load_scenes') as phase:
+                loaded = self.load_scenes([x for x in scene_configs.keys() if x not in scenes
+                                           and (x in affected_scene_paths or x in owner_scene_paths)], dialogs)
+                phase['atoms'], phase['storables'] = self.count_scene_atoms(loaded)
+            scenes.update(loaded)
+
+            # Pack, build dialog and save each affected scene
+            scene_weights = self.build_scenes(scenes, affected_scene_paths, dialog_atoms, package_atoms, index,
+                                              backfill_mask)
+
+        # Weights of scenes that weren't rebuilt are kept from the build that saved them
+        if self.weights:
+            weights = Weights(self.weights_path)
+            weights.update(scene_weights, [x.replace(os.sep, '/') for x in scene_configs.keys()])
+            weights.save()
+
+        # Record inputs and atom ids so unchanged projects and scenes can be skipped next time.  Packages
+        # are written from scratch, there are no scenes to skip.
+        if not self.package_path:
+            atom_sources = {scene_path: self.get_atom_source(inputs, scene_path) for scene_path in scene_configs.keys()}
+            manifest.update(inputs, shared, affected_scene_paths, atom_ids, atom_sources, dialog_atoms.keys())
+            manifest.save()
+        return True
+
+    def build_scenes_low_memory(self, scene_paths, dialogs, dialog_atoms, package_atoms, index, backfill_mask):
+        # Second pass of a low memory build.  Scenes owning backfilled atoms are loaded one at a time
+        # keeping only those atoms, then each scene is loaded, built and written before the next.
+        missing_mask = self.get_missing_mask(index, scene_paths, backfill_mask)
+        owned = {}
+        for atom_id in index.get_ids(missing_mask):
+            owned.setdefault(index.get_owner(atom_id), []).append(atom_id)
+        with self.metrics.phase('get_backfill_atoms') as phase:
+            backfill_atoms = {}
+            for owner_scene_path, atom_ids in owned.items():
+                scenes = self.load_scenes([owner_scene_path], dialogs, cached=False)
+                backfill_atoms.update(self.get_backfill_atoms(scenes, package_atoms, index, index.get_mask(atom_ids)))
+            backfill_atoms = {atom_id: backfill_atoms[atom_id] for atom_id in index.get_ids(missing_mask)}
+            phase['atoms'], phase['storables'] = count_atoms(backfill_atoms)
+        self.report_backfill_savings(index, scene_paths, backfill_atoms)
+
+        scene_weights = {}
+        for scene_path in scene_paths:
+            with self.metrics.phase('load_scenes') as phase:
+                scenes = self.load_scenes([scene_path], dialogs, cached=False)
+                phase['atoms'], phase['storables'] = self.count_scene_atoms(scenes)
+            if len(dialog_atoms):
+                with self.metrics.phase('pack_scenes:dialog') as phase:
+                    phase['atoms'] = self.pack_scenes(scenes, dialog_atoms, SOURCE_DIALOG)
+            scene_weights.update(self.scaffold_scenes(scenes, backfill_atoms, package_atoms)[1])
+        return scene_weights
+
+    def report_transitions(self):
+        # Compare every pair of built scenes, read back from the build path so unchanged scenes are included
+        scene_configs = self.get_scene_configs()
+        scenes = {scene_config.get('scene_path').replace('\\', '/'): Scene.load(self.get_build_scene_path(scene_path))
+                  for scene_path, scene_config in scene_configs.items()}
+        Transitions(scenes, self.get_story(scene_configs)).save(self.transitions_path)
+        logger.info("Saved scene transitions report: %s", self.transitions_path)
+        return len(scenes)
+
+    def get_story(self, scene_configs):
+        # Scenes that may follow each scene, given as 'next' in the blueprint
+        story = {}
+        for scene_config in scene_configs.values():
+            next_scene_paths = scene_config.get('next', [])
+            if isinstance(next_scene_paths, str):
+                next_scene_paths = [next_scene_paths]
+            for next_scene_path in next_scene_paths:
+                if next_scene_path.replace('/', os.sep).replace('\\', os.sep) not in scene_configs:
+                    raise Exception("Invalid next scene specified in config: %s" % next_scene_path)
+            if next_scene_paths:
+                scene_path = scene_config.get('scene_path').replace('\\', '/')
+                story.update({scene_path: [x.replace('\\', '/') for x in next_scene_paths]})
+        return story
+
+    def get_var_config(self, name, config):
+        # VaM names packages <creator>.<name>.<version>.var, the project name is the default package name
+        var_config = dict(DEFAULT_VAR_CONFIG, name=name)
+        var_config.update(config.get('var', {}))
+        for key in ['creator', 'name']:
+            if not var_config[key] or any(x in str(var_config[key]) for x in './\\ '):
+                raise Exception("Invalid package %s specified in blueprint: %s" % (key, var_config[key]))
+        if not str(var_config['version']).isdigit():
+            raise Exception("Invalid package version specified in blueprint: %s" % var_config['version'])
+        return var_config
+
+    def get_var_meta(self, var_config):
+        # meta.json of the package, its content list is added by the sink
+        return {
+            'licenseType': var_config['license'],
+            'creatorName': var_config['creator'],
+            'packageName': var_config['name'],
+            'standardReferenceVersionOption': 'Latest',
+            'scriptReferenceVersionOption': 'Exact',
+            'description': var_config['description'],
+            'credits': '',
+            'instructions': '',
+            'promotionalLink': '',
+            'dependencies': {},
+            'customOptions': {
+                'preloadMorphs': 'false'
+            },
+            'hadReferenceIssues': 'false',
+            'referenceIssues': []
+        }
+
+    def save_dialog_reports(self, reports):
+        serializer.dump(reports, self.dialogs_path, pretty=True)
+
+    def get_build_scene_path(self, relative_scene_path):
+        return self.sink.get_filepath(relative_scene_path)
+
+    def has_outputs(self, scene_paths):
+        return all(os.path.isfile(self.get_build_scene_path(scene_path)) for scene_path in scene_paths)
+
+    def get_scene_file_filter(self, scene_configs):
+        scene_filepaths = [os.path.normcase(os.path.join(self.source_path, scene_path))
+                           for scene_path in scene_configs.keys()]
+
+        def ignore(directory, names):
+            return [name for name in names if os.path.normcase(os.path.join(directory, name)) in scene_filepaths]
+        return ignore
+
+    def get_template_paths(self, scene_configs):
+        # Templates rendered while building the project's scenes
+        names = ['default', 'scene'] + ['packages/%s' % x for x in sorted(self.config.get('packages', {}).keys())]
+        if any(self.get_dialog_path(x) for x in scene_configs.values()):
+            names += DIALOG_TEMPLATES
+        return {name: os.path.join(self.templates_path, '%s.json' % name.replace('/', os.sep)) for name in names}
+
+    def get_graph(self, scene_configs=None):
+        # Each scene is built from its own blueprint entry, its source scene (or the scene template), its dialog
+        # and the templates rendering atoms it doesn't have.  Scenes only depend on each other's files where
+        # atoms are backfilled between them or the dialog atoms every scene shares have changed, found from the
+        # atom ids of each scene now and as recorded by the last build.
+        scene_configs = scene_configs or self.get_scene_configs()
+        manifest = Manifest(self.manifest_path)
+        inputs = self.get_inputs(scene_configs)
+        template_paths = self.get_template_paths(scene_configs)
+        blueprint_path = os.path.join(self.projects_path, self.name, 'blueprint.json')
+        dialog_paths = [self.get_dialog_path(x) for x in scene_configs.values() if self.get_dialog_path(x)]
+
+        # Only scenes changed since the last build are scanned for their atoms
+        atom_ids = self.get_recorded_atom_ids(manifest, inputs, scene_configs.keys())
+        atom_ids.update(self.scan_scenes([x for x in scene_configs.keys() if x not in atom_ids]))
         package_atoms = self.get_package_atoms()
-        logging.info("Found %d package atoms." % len(package_atoms))
-
-        # Get all scenes required to scaffold
-        scenes = self.get_scenes()
-        logging.info("Found %d scenes." % len(scenes))
-
-        # Get all dialog branch atoms to prefill scenes with
-        dialog_atoms = self.get_dialog_atoms(scenes)
-        logging.info("Found %d dialog atoms to add to scenes." % len(dialog_atoms))
-
-        # Prefill scenes with dialog branch atoms
-        if len(dialog_atoms):
-            logging.info("Pack dialog atoms into scenes..")
-            self.pack_scenes(scenes, dialog_atoms)
-
-        # Scan scenes for unspecified atoms (atoms that exist in one scene but not it's siblings)
-        backfill_atoms = self.get_backfill_atoms(scenes, package_atoms)
-        logging.info("Found %d atoms to backfill into scenes." % len(backfill_atoms))
-
-        # Backfill discovered atoms into scenes
-        if len(backfill_atoms):
-            logging.info("Pack discovered atoms into scenes..")
-            self.pack_scenes(scenes, backfill_atoms)
-
-        # Scan scenes for missing packages and pack them into scenes
-        if len(package_atoms):
-            logging.info("Scan scenes for missing packages and pack them into scenes..")
-            self.pack_scenes(scenes, package_atoms)
-
-            # Generate animation pattern atoms from twinery dialog trees and
-            # merge dialog animation patterns into relevant scenes (preserving existing triggers)
-            logging.info("Update dialog tree(s), triggers and actions..")
-            self.build_dialog(scenes)
-
-        # Save all scenes last
-        logging.info("Saving scenes to build path: %s" % self.build_path)
-        self.save_scenes(scenes)
-
-    def save_scenes(self, scenes):
-        for relative_scene_path, scene in scenes.items():
-            scene_path = os.path.join(self.build_path, relative_scene_path)
-            scene_path = scene_path.replace('/', os.sep).replace('\\', os.sep)
-            pathlib.Path(os.path.dirname(scene_path)).mkdir(parents=True, exist_ok=True)
-            json.dump(scene.build(), open(scene_path, 'w'))
-            logging.info("Saved scene: %s" % scene_path)
-
-    def pack_scenes(self, scenes, atoms):
-        for scene in scenes.values():
-            scene.pack(atoms)
-
-    def build_dialog(self, scenes):
-        for scene in scenes.values():
-            if not scene.dialog:
-                continue
-            scene.dialog.build(scene)
-
-    def get_dialog_atoms(self, scenes):
-        atoms = {}
-        self.dialog_branch_count_max = 0
-        self.dialog_choice_count_max = 0
-
-        # Determine dialog tree with the most branches and get choice count
-        for scene in scenes.values():
-            # Skip scenes without dialog attached
-            if not scene.dialog:
-                continue
-            # Get total dialog branches
-            scene_atom_count = scene.dialog.get_atom_counts()
-            if self.dialog_branch_count_max < scene_atom_count[0]:
-                self.dialog_branch_count_max = scene_atom_count[0]
-            if self.dialog_choice_count_max < scene_atom_count[1]:
-                self.dialog_choice_count_max = scene_atom_count[1]
-
-        # Create dialog containers
-        if self.dialog_branch_count_max > 0:
-            atoms.update(Dialog.scaffold_containers(self.templates_path))
-
-        # Build scaffolding for dialog branches
-        for idx in range(self.dialog_branch_count_max):
-            atoms.update(Dialog.scaffold_branch(self.templates_path, idx))
-
-        # Build scaffolding for dialog choices
-        for idx in range(self.dialog_choice_count_max):
-            atoms.update(Dialog.scaffold_choice(self.templates_path, idx))
-
-        logging.info("Maximum possible dialog branches per scene: %s" % self.dialog_branch_count_max)
-        logging.info("Maximum possible dialog choices per scene: %s" % self.dialog_choice_count_max)
-
-        return atoms
-
-    def get_backfill_atoms(self, scenes, package_atoms):
-        backfill_atoms = {}
-        for scene in scenes.values():
-            for atom_id, atom in scene.atoms.items():
-                if atom_id not in package_atoms.keys() and atom_id.split('#')[0] not in IGNORE_ATOMS:
-                    new_atom = atom.copy()
-                    new_atom.data['on'] = 'false'
-                    backfill_atoms.update({atom_id: new_atom})
-        return backfill_atoms
+        package_atom_ids = self.get_package_atom_ids()
+        dialog_atoms = self.get_dialog_atoms(self.load_dialogs(scene_configs))
+        index = self.index_atoms(scene_configs.keys(), atom_ids, dialog_atoms)
+        backfill_mask = self.get_backfill_mask(index, package_atoms)
+        recorded = manifest.get_all_atom_ids()
+        last_index = self.index_atoms(recorded.keys(), recorded, dict.fromkeys(manifest.dialog_atoms or []))
+        last_backfill_mask = self.get_backfill_mask(last_index, package_atoms)
+        changed_dialog_atoms = set(dialog_atoms.keys()) ^ set(manifest.dialog_atoms or [])
+
+        # Files each scene's own atoms come from, its blueprint entry too when that's new or has changed.
+        # Scenes gone from the blueprint took their atoms with them.
+        atom_filepaths = {scene_path: [blueprint_path] for scene_path in recorded.keys()}
+        for scene_path in scene_configs.keys():
+            atom_filepaths[scene_path] = [os.path.join(self.source_path, scene_path)]
+            if not inputs['scenes'][scene_path]['source']:
+                atom_filepaths[scene_path].append(template_paths['scene'])
+            if manifest.inputs.get('global', {}).get('blueprint.json') != inputs['global']['blueprint.json'] \
+                    or manifest.inputs.get('scenes', {}).get(scene_path, {}).get('config') \
+                    != inputs['scenes'][scene_path]['config']:
+                atom_filepaths[scene_path].append(blueprint_path)
+
+        graph = DependencyGraph()
+        for scene_path, scene_config in scene_configs.items():
+            filepaths = list(atom_filepaths[scene_path])
+            if self.get_dialog_path(scene_config):
+                filepaths += [self.get_dialog_path(scene_config)] + [template_paths[x] for x in DIALOG_TEMPLATES]
+            scene_atom_ids = set(atom_ids[scene_path])
+            for name, template_atom_ids in package_atom_ids.items():
+                if not scene_atom_ids.issuperset(template_atom_ids):
+                    filepaths.append(template_paths[name])
+            if not scene_atom_ids.issuperset(dialog_atoms.keys()):
+                filepaths += [template_paths[x] for x in DIALOG_ATOM_TEMPLATES]
+            if changed_dialog_atoms - scene_atom_ids:
+                filepaths += dialog_paths + [blueprint_path]
+
+            # Scenes the atoms it's missing are backfilled from, including those it was missing last build
+            for atom_id in index.get_ids(index.get_missing(scene_path, backfill_mask)):
+                filepaths += atom_filepaths[index.get_owner(atom_id)]
+            if scene_path in recorded:
+                for atom_id in last_index.get_ids(last_index.get_missing(scene_path, last_backfill_mask)):
+                    filepaths += atom_filepaths[last_index.get_owner(atom_id)]
+
+            for filepath in filepaths:
+                graph.add(scene_path, filepath)
+        return graph
+
+    def select_scenes(self, patterns=None, changed=None):
+        # Scenes matching any of the patterns (ie, 'SceneA.json' or 'chapter1/*') and depending on any
+        # of the changed files, None selects every scene
+        if not patterns and not changed:
+            return None
+        scene_configs = self.get_scene_configs()
+        selected = list(scene_configs.keys())
+        if patterns:
+            selected = [scene_path for scene_path in selected
+                        if any(fnmatch(scene_path.replace(os.sep, '/'), pattern.replace('\\', '/'))
+                               or fnmatch(os.path.basename(scene_path), pattern) for pattern in patterns)]
+        if changed:
+            dependents = self.get_graph(scene_configs).get_dependents(*changed)
+            selected = [scene_path for scene_path in selected if scene_path in dependents]
+        return selected
+
+    def get_inputs(self, scene_configs):
+        # Content hashes of everything a build reads, split into inputs shared by the
+        # whole project and inputs belonging to a single scene
+        # Each scene's blueprint entry is an input of that scene alone
+        shared_inputs = {
+            'blueprint.json': hash_data({key: value for key, value in self.config.items() if key != 'scenes'})
+        }
+        for name, filepath in self.get_template_paths(scene_configs).items():
+            shared_inputs.update({'templates/%s.json' % name: hash_file(filepath)})
+
+        scene_inputs = {}
+        for scene_path, scene_config in scene_configs.items():
+            source_filepath = os.path.join(self.source_path, scene_path)
+            dialog_filepath = self.get_dialog_path(scene_config)
+            scene_inputs.update({scene_path: {
+                'config': hash_data(scene_config),
+                'source': hash_file(source_filepath) if os.path.isfile(source_filepath) else None,
+                'dialog': hash_file(dialog_filepath) if dialog_filepath else None
+            }})
+
+        return {'global': shared_inputs, 'scenes': scene_inputs}
+
+    def get_recorded_atom_ids(self, manifest, inputs, scene_paths):
+        # Atom ids of each scene recorded by the last build, for scenes that haven't changed since
+        atom_ids = {}
+        for scene_path in scene_paths:
+            scene_atom_ids = manifest.get_atom_ids(scene_path, self.get_atom_source(inputs, scene_path))
+            if scene_atom_ids is not None:
+                atom_ids.update({scene_path: scene_atom_ids})
+        return atom_ids
+
+    def get_atom_source(self, inputs, scene_path):
+        # Scenes without a source start from the scene template, their atoms change along with it
+        return inputs['scenes'][scene_path]['source'] or inputs['global'].get('templates/scene.json')
+
+    def get_shared_fingerprint(self, dialog_atoms, index, backfill_mask, inputs):
+        # Backfilled atoms are identified by the scene they're copied from and that scene's content,
+        # so the fingerprint doesn't need any scene to be loaded
+        return hash_data({
+            'dialog': sorted(dialog_atoms.keys()),
+            'backfill': {atom_id: [index.get_owner(atom_id), inputs['scenes'][index.get_owner(atom_id)]['source']]
+                         for atom_id in index.get_ids(backfill_mask)}
+        })
+
+    def load_dialogs(self, scene_configs):
+        dialogs = {}
+        for scene_config in scene_configs.values():
+            dialog_path = self.get_dialog_path(scene_config)
+            if dialog_path:
+                dialogs.update({scene_config.get('dialog_path'): Dialog.load(self.templates_path, dialog_path)})
+        return self.get_dialogs(scene_configs, dialogs)
+
+    def get_cached(self, kind, filepaths, loader):
+        # Reuse a previously loaded value while none of the files it was loaded from have changed
+        key = tuple((filepath, os.stat(filepath).st_size, os.stat(filepath).st_mtime_ns) for filepath in filepaths)
+        cached = self.cache.get(kind)
+        if cached and cached[0] == key:
+            return cached[1]
+        value = loader()
+        self.cache.update({kind: (key, value)})
+        return value
 
     def get_package_atoms(self):
-        default_atoms_path = os.path.join(self.templates_path, 'default.json')
-        atoms = json.load(open(default_atoms_path, 'r'))
-        for pkg_name, pkg_count in self.config.get('packages', {}).items():
-            atom_name = pkg_name.split('/')[0]
-            raw = open(os.path.join(self.packages_path, '%s.json' % pkg_name), 'r').read()
-            for idx in range(pkg_count):
-                pack_id = atom_name if idx == 0 else '%s#%d' % (atom_name, idx + 1)
-                atoms += json.loads(raw.replace('$ID', pack_id))
-        return {atom.get('id'): Atom(atom) for atom in atoms}
-
-    def get_scenes(self):
-        # Get list of all scenes, both existing and those specified in config
-        scene_template = json.load(open(os.path.join(self.templates_path, 'scene.json'), 'r'))
-        project_scenes = {}
-        for scene in self.config.get('scenes', []):
-            if isinstance(scene, str):
-                scene_path = scene.replace('/', os.sep).replace('\\', os.sep)
-                project_scenes.update({scene_path: {'scene_path': scene}})
-            else:
-                scene_path = scene.get('scene_path').replace('/', os.sep).replace('\\', os.sep)
-                project_scenes.update({scene_path: scene})
-
-        # Find existing scene files
-        existing_scene_paths = [y.replace(self.build_path + os.sep, '')
-                                for x in os.walk(self.build_path)
-                                for y in glob(os.path.join(x[0], '*.json'))]
-
-        # Build out scene objects and corresponding dialog
+        return self.get_cached_packages('packages', self.load_package_atoms)
+
+    def get_package_atom_ids(self):
+        # Atom ids rendered by the default template and each package, by template name
+        return self.get_cached_packages('package_ids', lambda: {
+            name: [atom.get('id') for atom in atoms] for name, atoms in self.render_packages().items()
+        })
+
+    def get_cached_packages(self, kind, loader):
+        packages = sorted(self.config.get('packages', {}).items())
+        filepaths = [os.path.join(self.templates_path, 'default.json')] + \
+            [os.path.join(self.packages_path, '%s.json' % pkg_name) for pkg_name, pkg_count in packages]
+        return self.get_cached((kind, tuple(packages)), filepaths, loader)
+
+    def get_dialog_path(self, scene_config):
+        if not scene_config.get('dialog_path'):
+            return None
+        return os.path.join(self.projects_path, self.name, scene_config.get('dialog_path')) \
+            .replace('/', os.sep).replace('\\', os.sep)
+
+    def scan_scenes(self, scene_paths):
+        # Atom ids of each scene, holding a single scene in memory at a time
+        atom_ids = {}
+        for scene_path in scene_paths:
+            scene = self.load_scenes([scene_path], {}, cached=False)[scene_path]
+            atom_ids.update({scene_path: list(scene.atoms.keys())})
+        return atom_ids
+
+    def load_scenes(self, scene_paths, dialogs, cached=True):
+        # Scenes found in the project's scene directory are loaded, the rest start from the scene template.
+        # Uncached scenes aren't kept around for the next build in watch mode.
+        scene_configs = self.get_scene_configs()
         scenes = {}
-        for scene_path, scene_config in project_scenes.items():
+        for scene_path in scene_paths:
             if not scene_path.lower().endswith('.json'):
-                raise Exception("Invalid scene path specified in config: %s" % scene_path)
-            dialog = None
-            if scene_config.get('dialog_path'):
-                dialog_path = os.path.join(self.projects_path, self.name, scene_config.get('dialog_path')) \
-                    .replace('/', os.sep).replace('\\', os.sep)
-                dialog = Dialog(self.templates_path, dialog_path)
-            if scene_path in existing_scene_paths:
-                abs_scene_path = os.path.join(self.build_path, scene_path).replace('/', os.sep).replace('\\', os.sep)
-                scene_data = json.load(open(abs_scene_path, 'r'))
+                raise Exception("Invalid scene path specified in config: %s"
+                                % scene_configs[scene_path].get('scene_path'))
+            abs_scene_path = os.path.join(self.source_path, scene_path)
+            if os.path.isfile(abs_scene_path) and not cached:
+                scene = Scene.load(abs_scene_path)
+            elif os.path.isfile(abs_scene_path):
+                # Cached scenes are kept pristine, each build works on a copy on write view
+                scene = self.get_cached(('scene', abs_scene_path), [abs_scene_path],
+                                        lambda: Scene.load(abs_scene_path)).copy()
             else:
-                scene_data = copy.deepcopy(scene_template)
-            scenes.update({scene_path: Scene(scene_data, dialog)})
-
+                scene = Scene(self.templates.render('scene'))
+            scene.dialog = dialogs.get(scene_path)
+            scenes.update({scene_path: scene})
         return scenes
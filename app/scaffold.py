@@ -0,0 +1,385 @@
+import os
+
+from .vam.scene import Scene
+from .vam.atom import Atom
+from .dialog import Dialog
+from .analyzer import analyze
+from .index import AtomIndex
+from .template import TemplateRegistry
+from .pipeline import ScenePipeline
+from .sinks import MemorySink
+from .weights import get_scene_weights
+from .metrics import Metrics, count_atoms
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+IGNORE_ATOMS = ['AnimationStep']
+
+BACKFILL_FULL = 'full'
+BACKFILL_STUB = 'stub'
+
+# Smallest atom VAM will still merge-load, used when backfilling in stub mode
+STUB_ATOM_KEYS = ['id', 'on', 'type', 'parentAtom']
+STUB_STORABLES = ['AtomControl', 'control']
+
+# Where atoms packed into scenes come from, reported by scene weights
+SOURCE_PACKAGE = 'package'
+SOURCE_DIALOG = 'dialog'
+SOURCE_BACKFILL = 'backfill'
+
+
+class Scaffold(object):
+    dialog_branch_count_max = 0
+    dialog_choice_count_max = 0
+
+    def __init__(self, name, config, templates, workers=1, profile=False, weights=False, sink=None, check=False):
+        # Builds a blueprint's scenes without touching the filesystem, templates are given as a directory
+        # or a template registry and built scenes are handed to the sink (kept in memory by default).
+        # Checked builds analyze their dialogs first and fail on broken ones.
+        self.name = name
+        self.config = config
+        self.workers = workers
+        self.profile = profile
+        self.weights = weights
+        self.check = check
+        self.metrics = Metrics(self.name, self.profile)
+        self.templates = TemplateRegistry.get_registry(templates)
+        self.sink = sink if sink is not None else MemorySink()
+
+        self.backfill = self.config.get('backfill', BACKFILL_FULL)
+        if self.backfill not in [BACKFILL_FULL, BACKFILL_STUB]:
+            raise Exception("Invalid backfill mode specified in blueprint: %s" % self.backfill)
+        self.backfill_savings = {}
+
+    def run(self, build, *args):
+        # Run a build with fresh metrics, the sink is closed once every scene is written or aborted if it fails
+        self.metrics = Metrics(self.name, self.profile)
+        self.metrics.start()
+        try:
+            result = build(*args)
+            self.sink.close()
+        except BaseException:
+            self.sink.abort()
+            raise
+        finally:
+            self.metrics.stop()
+        return result
+
+    def build(self, scenes=None, dialogs=None):
+        # Build every scene in the blueprint.  Source scenes are keyed by their scene path and dialogs by
+        # their dialog path (as given in the blueprint), either parsed, as raw bytes or already loaded.
+        # Scenes without a source start from the scene template.  Returns the built scenes, scenes built
+        # by scene workers are only seen by the sink.
+        return self.run(self.build_blueprint, scenes or {}, dialogs or {})
+
+    def build_blueprint(self, scenes, dialogs):
+        scene_configs = self.get_scene_configs()
+        dialogs = self.get_dialogs(scene_configs, dialogs)
+        package_atoms, dialog_atoms = self.get_atoms(scene_configs, dialogs)
+
+        with self.metrics.phase('load_scenes') as phase:
+            scenes = self.get_scenes(scene_configs, scenes, dialogs)
+            phase['atoms'], phase['storables'] = self.count_scene_atoms(scenes)
+
+        atom_ids = {scene_path: list(scene.atoms.keys()) for scene_path, scene in scenes.items()}
+        index, backfill_mask = self.index_scenes(scene_configs.keys(), atom_ids, dialog_atoms, package_atoms)
+        self.build_scenes(scenes, list(scenes.keys()), dialog_atoms, package_atoms, index, backfill_mask)
+        return scenes
+
+    def get_atoms(self, scene_configs, dialogs):
+        # Get all atoms to pack into scenes and the dialog branch atoms to prefill them with, catching
+        # broken dialogs first if checking
+        with self.metrics.phase('get_package_atoms') as phase:
+            package_atoms = self.get_package_atoms()
+            phase['atoms'], phase['storables'] = count_atoms(package_atoms)
+        logger.info("Found %d package atoms.", len(package_atoms))
+
+        if self.check:
+            # The reports are saved before failing, they're most needed when the check fails
+            reports, errors = self.check_dialogs(scene_configs, dialogs)
+            self.save_dialog_reports(reports)
+            if errors:
+                raise Exception("Dialog check failed: %s" % '; '.join(errors))
+        with self.metrics.phase('get_dialog_atoms') as phase:
+            dialog_atoms = self.get_dialog_atoms(dialogs)
+            phase['atoms'], phase['storables'] = count_atoms(dialog_atoms)
+        logger.info("Found %d dialog atoms to add to scenes.", len(dialog_atoms))
+        return package_atoms, dialog_atoms
+
+    def save_dialog_reports(self, reports):
+        # Dialog analysis reports of checked builds, only logged unless saved somewhere
+        pass
+
+    def index_scenes(self, scene_paths, atom_ids, dialog_atoms, package_atoms):
+        # Scan scenes for unspecified atoms (atoms that exist in one scene but not it's siblings)
+        index = self.index_atoms(scene_paths, atom_ids, dialog_atoms)
+        backfill_mask = self.get_backfill_mask(index, package_atoms)
+        logger.info("Found %d atoms to backfill into scenes.", len(index.get_ids(backfill_mask)))
+        return index, backfill_mask
+
+    def get_missing_mask(self, index, scene_paths, backfill_mask):
+        # Backfilled atoms any of the scenes are missing
+        missing_mask = 0
+        for scene_path in scene_paths:
+            missing_mask |= index.get_missing(scene_path, backfill_mask)
+        return missing_mask
+
+    def build_scenes(self, scenes, scene_paths, dialog_atoms, package_atoms, index, backfill_mask):
+        # Build the given scene paths, scenes must include every scene owning atoms they are missing.
+        # Returns the weights of each built scene, if weighing them.
+        missing_mask = self.get_missing_mask(index, scene_paths, backfill_mask)
+        affected_scenes = {scene_path: scenes[scene_path] for scene_path in scene_paths}
+
+        # Prefill scenes with dialog branch atoms
+        if len(dialog_atoms):
+            logger.debug("Pack dialog atoms into scenes..")
+            with self.metrics.phase('pack_scenes:dialog') as phase:
+                phase['atoms'] = self.pack_scenes(affected_scenes, dialog_atoms, SOURCE_DIALOG)
+
+        # Copy the atoms affected scenes are missing from the last scene containing them
+        with self.metrics.phase('get_backfill_atoms') as phase:
+            backfill_atoms = self.get_backfill_atoms(scenes, package_atoms, index, missing_mask)
+            phase['atoms'], phase['storables'] = count_atoms(backfill_atoms)
+        self.report_backfill_savings(index, scene_paths, backfill_atoms)
+
+        # Pack, build dialog and save each affected scene, fanning out across workers if the sink allows
+        if self.workers > 1 and len(affected_scenes) > 1 and self.sink.multiprocess:
+            with self.metrics.phase('scene_pipeline') as phase:
+                phase['bytes'], scene_weights = ScenePipeline(self, self.workers).run(affected_scenes, backfill_atoms,
+                                                                                      package_atoms)
+        else:
+            scene_weights = self.scaffold_scenes(affected_scenes, backfill_atoms, package_atoms)[1]
+        return scene_weights
+
+    def scaffold_scenes(self, scenes, backfill_atoms, package_atoms):
+        # Backfill discovered atoms into scenes
+        if len(backfill_atoms):
+            logger.debug("Pack discovered atoms into scenes..")
+            with self.metrics.phase('pack_scenes:backfill') as phase:
+                phase['atoms'] = self.pack_scenes(scenes, backfill_atoms, SOURCE_BACKFILL)
+
+        # Scan scenes for missing packages and pack them into scenes
+        if len(package_atoms):
+            logger.debug("Scan scenes for missing packages and pack them into scenes..")
+            with self.metrics.phase('pack_scenes:package') as phase:
+                phase['atoms'] = self.pack_scenes(scenes, package_atoms, SOURCE_PACKAGE)
+
+            # Generate animation pattern atoms from twinery dialog trees and
+            # merge dialog animation patterns into relevant scenes (preserving existing triggers)
+            logger.debug("Update dialog tree(s), triggers and actions..")
+            with self.metrics.phase('build_dialog') as phase:
+                phase['atoms'] = self.build_dialog(scenes)
+
+        # Save all scenes last
+        with self.metrics.phase('save_scenes') as phase:
+            phase['atoms'], phase['storables'] = self.count_scene_atoms(scenes)
+            phase['bytes'] = total_bytes = self.save_scenes(scenes)
+
+        # Break down what each scene is made of, returned as the scenes may have been built by a worker
+        scene_weights = {}
+        if self.weights:
+            with self.metrics.phase('weigh_scenes') as phase:
+                for scene_path, scene in scenes.items():
+                    scene_weights.update({scene_path.replace(os.sep, '/'): get_scene_weights(scene, SOURCE_PACKAGE)})
+                phase['scenes'] = len(scene_weights)
+        return total_bytes, scene_weights
+
+    def index_atoms(self, scene_paths, atom_ids, dialog_atoms):
+        # Index which atoms each scene will contain once prefilled with dialog atoms, so scans across
+        # scenes are set operations
+        with self.metrics.phase('index_atoms') as phase:
+            index = AtomIndex()
+            for scene_path in scene_paths:
+                existing = set(atom_ids[scene_path])
+                index.add_ids(scene_path, atom_ids[scene_path] + [x for x in dialog_atoms.keys() if x not in existing])
+            phase['atoms'] = len(index.bits)
+        return index
+
+    def count_scene_atoms(self, scenes):
+        counts = [count_atoms(scene.atoms) for scene in scenes.values()]
+        return sum(x[0] for x in counts), sum(x[1] for x in counts)
+
+    def save_scenes(self, scenes):
+        total_bytes = 0
+        for scene_path, scene in scenes.items():
+            total_bytes += self.sink.write(scene_path, scene)
+        return total_bytes
+
+    def pack_scenes(self, scenes, atoms, source=None):
+        packed = 0
+        for scene in scenes.values():
+            packed += scene.pack(atoms, source)
+        return packed
+
+    def build_dialog(self, scenes):
+        # Returns the number of dialog atoms written
+        atoms = 0
+        for scene in scenes.values():
+            if scene.dialog:
+                atoms += scene.dialog.build(scene)
+        return atoms
+
+    def get_dialogs(self, scene_configs, dialogs):
+        # Dialogs given by their dialog path, shared by every scene using the same dialog path
+        loaded = {}
+        for scene_config in scene_configs.values():
+            dialog_path = scene_config.get('dialog_path')
+            if dialog_path and dialog_path not in loaded:
+                if dialog_path not in dialogs:
+                    raise Exception("Dialog not found: %s" % dialog_path)
+                dialog = dialogs[dialog_path]
+                if not isinstance(dialog, Dialog):
+                    data = serializer.loads(dialog) if isinstance(dialog, (bytes, str)) else dialog
+                    dialog = Dialog(self.templates, dialog_path, data)
+                loaded.update({dialog_path: dialog})
+        return {scene_path: loaded[scene_config.get('dialog_path')]
+                for scene_path, scene_config in scene_configs.items() if scene_config.get('dialog_path')}
+
+    def check_dialogs(self, scene_configs, dialogs):
+        # Analyze each dialog before it's compiled into scenes.  Returns the analysis of each dialog by its
+        # dialog path along with the problems that would break the build or the dialog in game.
+        reports = {}
+        errors = []
+        with self.metrics.phase('check_dialogs') as phase:
+            for scene_path, scene_config in scene_configs.items():
+                dialog_path = scene_config.get('dialog_path')
+                if not dialog_path or dialog_path in reports:
+                    continue
+                analysis = analyze(dialogs[scene_path])
+                reports.update({dialog_path: analysis.report()})
+                summary = {
+                    'dialog': dialog_path,
+                    'branches': len(analysis.branches),
+                    'dead_ends': len(analysis.dead_ends),
+                    'fan_out': analysis.fan_out
+                }
+                logger.info("Checked dialog: %(dialog)s (%(branches)d branches, %(dead_ends)d dead ends, "
+                            "fan out %(fan_out)d)", summary)
+                for warning in analysis.warnings:
+                    logger.warning("%(dialog)s: %(warning)s", {'dialog': dialog_path, 'warning': warning})
+                errors += ["%s: %s" % (dialog_path, error) for error in analysis.errors]
+            phase['dialogs'] = len(reports)
+        return reports, errors
+
+    def get_scenes(self, scene_configs, scenes, dialogs):
+        # Source scenes given by their scene path, the rest start from the scene template
+        sources = {scene_path.replace('/', os.sep).replace('\\', os.sep): scene for scene_path, scene in scenes.items()}
+        loaded = {}
+        for scene_path in scene_configs.keys():
+            source = sources.get(scene_path)
+            if isinstance(source, (bytes, str)):
+                source = Scene(serializer.loads(source, interned=True))
+            elif isinstance(source, dict):
+                source = Scene(source)
+            # Builds work on a copy on write view, leaving the caller's scenes untouched
+            scene = source.copy() if source is not None else Scene(self.templates.render('scene'))
+            scene.dialog = dialogs.get(scene_path)
+            loaded.update({scene_path: scene})
+        return loaded
+
+    def get_dialog_atoms(self, dialogs):
+        atoms = {}
+        self.dialog_branch_count_max = 0
+        self.dialog_choice_count_max = 0
+
+        # Determine dialog tree with the most branches and get choice count
+        for dialog in dialogs.values():
+            # Get total dialog branches
+            scene_atom_count = dialog.get_atom_counts()
+            if self.dialog_branch_count_max < scene_atom_count[0]:
+                self.dialog_branch_count_max = scene_atom_count[0]
+            if self.dialog_choice_count_max < scene_atom_count[1]:
+                self.dialog_choice_count_max = scene_atom_count[1]
+
+        # Create dialog containers
+        if self.dialog_branch_count_max > 0:
+            atoms.update(Dialog.scaffold_containers(self.templates))
+
+        # Build scaffolding for dialog branches
+        for idx in range(self.dialog_branch_count_max):
+            atoms.update(Dialog.scaffold_branch(self.templates, idx))
+
+        # Build scaffolding for dialog choices
+        for idx in range(self.dialog_choice_count_max):
+            atoms.update(Dialog.scaffold_choice(self.templates, idx))
+
+        logger.info("Maximum possible dialog branches per scene: %s", self.dialog_branch_count_max)
+        logger.info("Maximum possible dialog choices per scene: %s", self.dialog_choice_count_max)
+
+        return atoms
+
+    def get_backfill_mask(self, index, package_atoms):
+        # Every atom found in any scene that isn't provided by a package
+        return index.all & ~index.get_mask(package_atoms.keys()) & ~index.get_prefix_mask(*IGNORE_ATOMS)
+
+    def get_backfill_atoms(self, scenes, package_atoms, index=None, mask=None):
+        # Backfilled atoms (all of them unless a mask is given) are taken from the last scene containing them
+        index = index or AtomIndex(scenes)
+        mask = self.get_backfill_mask(index, package_atoms) if mask is None else mask
+        backfill_atoms = {}
+        for atom_id in index.get_ids(mask):
+            atom = scenes[index.get_owner(atom_id)].atoms[atom_id]
+            if self.backfill == BACKFILL_STUB:
+                new_atom = atom.stub(STUB_ATOM_KEYS, STUB_STORABLES)
+                self.backfill_savings.update({
+                    atom_id: len(serializer.dumps(atom.build())) - len(serializer.dumps(new_atom.build()))
+                })
+            else:
+                new_atom = atom.copy()
+            new_atom.data['on'] = 'false'
+            backfill_atoms.update({atom_id: new_atom})
+        return backfill_atoms
+
+    def report_backfill_savings(self, index, scene_paths, backfill_atoms):
+        # Reported once for every scene being built, before they're handed to scene workers or built one
+        # at a time.  Scenes are stubbed the backfilled atoms they are missing.
+        if self.backfill != BACKFILL_STUB or not backfill_atoms:
+            return 0
+        backfill_mask = index.get_mask(backfill_atoms.keys())
+        total = 0
+        scenes = {}
+        for scene_path in scene_paths:
+            stubbed = index.get_ids(index.get_missing(scene_path, backfill_mask))
+            saved = sum(self.backfill_savings.get(atom_id, 0) for atom_id in stubbed)
+            total += saved
+            scenes.update({scene_path.replace(os.sep, '/'): {'atoms': len(stubbed), 'bytes': saved}})
+            logger.debug("Stubbed %d backfill atoms, saving %d bytes: %s", len(stubbed), saved, scene_path)
+        logger.info("Stub backfill saved %d bytes across %d scenes.", total, len(scene_paths))
+        # Saved with the build's metrics
+        self.metrics.add_report('backfill_savings', {'bytes': total, 'scenes': scenes})
+        return total
+
+    def get_package_atoms(self):
+        return self.load_package_atoms()
+
+    def render_packages(self):
+        # Atoms rendered by the default template and each package, by template name
+        rendered = {'default': self.templates.render_shared('default')}
+        for pkg_name, pkg_count in self.config.get('packages', {}).items():
+            atom_name = pkg_name.split('/')[0]
+            template = self.templates.get('packages/%s' % pkg_name)
+            atoms = []
+            for idx in range(pkg_count):
+                pack_id = atom_name if idx == 0 else '%s#%d' % (atom_name, idx + 1)
+                atoms += template.render_shared(ID=pack_id)
+            rendered.update({'packages/%s' % pkg_name: atoms})
+        return rendered
+
+    def load_package_atoms(self):
+        # Every copy of a package shares its static storables, atoms copy them before writing
+        atoms = [atom for rendered in self.render_packages().values() for atom in rendered]
+        return {atom.get('id'): Atom(atom, shared=True) for atom in atoms}
+
+    def get_scene_configs(self):
+        project_scenes = {}
+        for scene in self.config.get('scenes', []):
+            if isinstance(scene, str):
+                scene_path = scene.replace('/', os.sep).replace('\\', os.sep)
+                project_scenes.update({scene_path: {'scene_path': scene}})
+            else:
+                scene_path = scene.get('scene_path').replace('/', os.sep).replace('\\', os.sep)
+                project_scenes.update({scene_path: scene})
+        return project_scenes
@@ -0,0 +1,116 @@
+import sys
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Backends in order of preference, the first one installed is used unless one is chosen
+BACKEND_ORJSON = 'orjson'
+BACKEND_UJSON = 'ujson'
+BACKEND_JSON = 'json'
+BACKENDS = [BACKEND_ORJSON, BACKEND_UJSON, BACKEND_JSON]
+
+# Backend chosen in this process, worker processes are given their parent's (see get_backend)
+_backend = None
+
+# Longer strings (ie, dialog text and file paths) are rarely repeated and not worth interning
+INTERN_MAX_LENGTH = 64
+
+
+def get_available_backends():
+    modules = {BACKEND_ORJSON: orjson, BACKEND_UJSON: ujson, BACKEND_JSON: json}
+    return [name for name in BACKENDS if modules.get(name)]
+
+
+def get_backend():
+    return _backend or get_available_backends()[0]
+
+
+def set_backend(backend):
+    global _backend
+    if backend not in get_available_backends():
+        raise Exception("JSON backend is not available: %s" % backend)
+    _backend = backend
+
+
+def intern_data(data):
+    # Short string values repeat across every atom, scene and package ("true", "0", storable ids..),
+    # interned they share a single string object however many copies are loaded.  Values are
+    # replaced in place, repeated keys are already reused by the parsers.
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        items = node.items() if type(node) is dict else enumerate(node)
+        for key, value in items:
+            value_type = type(value)
+            if value_type is str:
+                if len(value) <= INTERN_MAX_LENGTH:
+                    node[key] = sys.intern(value)
+            elif value_type is dict or value_type is list:
+                stack.append(value)
+    return data
+
+
+def loads(data, backend=None, interned=False):
+    backend = backend or get_backend()
+    if backend == BACKEND_ORJSON:
+        data = orjson.loads(data)
+    elif backend == BACKEND_UJSON:
+        data = ujson.loads(data)
+    else:
+        data = json.loads(data)
+    return intern_data(data) if interned else data
+
+
+def dumps(data, pretty=False, backend=None):
+    # Always returns utf-8 encoded bytes.  Pretty output is indented with sorted keys.
+    backend = backend or get_backend()
+    if backend == BACKEND_ORJSON:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0)
+    if backend == BACKEND_UJSON:
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False,
+                           indent=2 if pretty else 0, sort_keys=pretty).encode('utf-8')
+    if pretty:
+        return json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+    return json.dumps(data).encode('utf-8')
+
+
+def iter_dumps(data, key, items, backend=None):
+    # Encodes data exactly like dumps (not pretty) a piece at a time, with the list under key taken
+    # from items and encoded one item at a time so neither it nor the output is held as a whole
+    backend = backend or get_backend()
+    item_separator = dumps([0, 0], backend=backend)[2:-2]
+    key_separator = dumps({'': 0}, backend=backend)[3:-2]
+    yield b'{'
+    for idx, (name, value) in enumerate(data.items()):
+        if idx:
+            yield item_separator
+        yield dumps(name, backend=backend) + key_separator
+        if name != key:
+            yield dumps(value, backend=backend)
+            continue
+        yield b'['
+        for item_idx, item in enumerate(items):
+            if item_idx:
+                yield item_separator
+            yield dumps(item, backend=backend)
+        yield b']'
+    yield b'}'
+
+
+def load(filepath, backend=None, interned=False):
+    return loads(open(filepath, 'rb').read(), backend, interned)
+
+
+def dump(data, filepath, pretty=False, backend=None):
+    # Returns the number of bytes written
+    raw = dumps(data, pretty, backend)
+    open(filepath, 'wb').write(raw)
+    return len(raw)
@@ -0,0 +1,147 @@
+import os
+import zipfile
+import tempfile
+
+from .sync import write_if_changed, write_chunks_if_changed, iter_tree, set_mode
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Deflate levels for .var packages, 0 stores files uncompressed
+DEFAULT_COMPRESSION = 6
+STORE_ONLY = 0
+
+
+class SceneSink(object):
+    # Receives each scene as soon as it's built.  Sinks that can be pickled and written to from
+    # several processes at once let scenes be built by scene workers.
+    multiprocess = False
+
+    def write(self, scene_path, scene):
+        # Returns the number of bytes written, if any
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def abort(self):
+        # Called instead of close when the build fails
+        pass
+
+
+class DirectorySink(SceneSink):
+    multiprocess = True
+
+    def __init__(self, path, streaming=False):
+        self.path = path
+        # Streamed scenes are encoded and written an atom at a time instead of as a single buffer
+        self.streaming = streaming
+
+    def get_filepath(self, scene_path):
+        return os.path.join(self.path, scene_path).replace('/', os.sep).replace('\\', os.sep)
+
+    def write(self, scene_path, scene):
+        filepath = self.get_filepath(scene_path)
+        if self.streaming:
+            changed, size = write_chunks_if_changed(filepath, scene.iter_dumps())
+        else:
+            data = serializer.dumps(scene.build())
+            changed, size = write_if_changed(filepath, data), len(data)
+        logger.debug("Saved scene: %(path)s (%(bytes)d bytes)" if changed else "Scene unchanged: %(path)s",
+                     {'path': filepath, 'bytes': size})
+        return size
+
+
+class MemorySink(SceneSink):
+    def __init__(self):
+        self.scenes = {}
+
+    def write(self, scene_path, scene):
+        self.scenes.update({scene_path: scene})
+        return 0
+
+
+class CallbackSink(SceneSink):
+    def __init__(self, callback):
+        # Called with the scene path and scene, ie. to serialize it somewhere of the caller's choosing
+        self.callback = callback
+
+    def write(self, scene_path, scene):
+        return self.callback(scene_path, scene) or 0
+
+
+class VarSink(SceneSink):
+    # Streams scenes and assets into a VaM package (.var, a zip archive with a meta.json) in a single
+    # sequential pass.  The package is written to a temporary file that only replaces filepath once closed.
+    def __init__(self, filepath, root_path, meta, compression=DEFAULT_COMPRESSION, streaming=False):
+        if not isinstance(compression, int) or not STORE_ONLY <= compression <= 9:
+            raise Exception("Invalid compression level: %s" % compression)
+        self.filepath = filepath
+        # Directory inside the package scenes and assets are placed under, ie. 'Saves/scene/name'
+        self.root_path = root_path.strip('/')
+        self.meta = meta
+        self.compression = compression
+        self.streaming = streaming
+        self.archive = None
+        self.temp_filepath = None
+        self.contents = []
+
+    def get_archive(self):
+        # Opened on first write, so projects that are never built don't leave an empty package behind
+        if self.archive is None:
+            directory = os.path.dirname(self.filepath)
+            os.makedirs(directory, exist_ok=True)
+            fd, self.temp_filepath = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+            os.close(fd)
+            if self.compression == STORE_ONLY:
+                self.archive = zipfile.ZipFile(self.temp_filepath, 'w', zipfile.ZIP_STORED)
+            else:
+                self.archive = zipfile.ZipFile(self.temp_filepath, 'w', zipfile.ZIP_DEFLATED,
+                                               compresslevel=self.compression)
+        return self.archive
+
+    def get_arcname(self, relative_path):
+        return '%s/%s' % (self.root_path, relative_path.replace(os.sep, '/').replace('\\', '/'))
+
+    def write(self, scene_path, scene):
+        arcname = self.get_arcname(scene_path)
+        chunks = scene.iter_dumps() if self.streaming else [serializer.dumps(scene.build())]
+        size = 0
+        with self.get_archive().open(arcname, 'w') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        self.contents.append(arcname)
+        logger.debug("Packed scene: %(path)s (%(bytes)d bytes)", {'path': arcname, 'bytes': size})
+        return size
+
+    def add_tree(self, source_path, ignore=None):
+        # Copy every file under source_path straight into the package, returns their relative paths
+        added = set()
+        for relative_filepath in iter_tree(source_path, ignore):
+            arcname = self.get_arcname(relative_filepath)
+            self.get_archive().write(os.path.join(source_path, relative_filepath), arcname)
+            self.contents.append(arcname)
+            added.add(relative_filepath)
+        logger.info("Packed %d files: %s -> %s", len(added), source_path, self.filepath)
+        return added
+
+    def close(self):
+        meta = dict(self.meta)
+        meta.update({'contentList': sorted(self.contents)})
+        archive = self.get_archive()
+        archive.writestr('meta.json', serializer.dumps(meta, pretty=True))
+        archive.close()
+        set_mode(self.temp_filepath, self.filepath)
+        os.replace(self.temp_filepath, self.filepath)
+        self.archive = None
+        logger.info("Saved package: %s (%d files)", self.filepath, len(self.contents))
+
+    def abort(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.temp_filepath and os.path.exists(self.temp_filepath):
+            os.remove(self.temp_filepath)
@@ -0,0 +1,143 @@
+import os
+import stat
+import shutil
+import filecmp
+import tempfile
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def is_stale(source_filepath, target_filepath):
+    if not os.path.isfile(target_filepath):
+        return True
+    source_stat = os.stat(source_filepath)
+    target_stat = os.stat(target_filepath)
+    return source_stat.st_size != target_stat.st_size or source_stat.st_mtime_ns != target_stat.st_mtime_ns
+
+
+def link_or_copy(source_filepath, target_filepath):
+    # Hard link where possible (same volume), otherwise copy keeping the modified time
+    if os.path.lexists(target_filepath):
+        os.remove(target_filepath)
+    try:
+        os.link(source_filepath, target_filepath)
+    except OSError:
+        shutil.copy2(source_filepath, target_filepath)
+
+
+def sync_tree(source_path, target_path, ignore=None):
+    # Mirror files from source_path into target_path, only touching files whose size or modified
+    # time differ.  Returns the relative path of every file mirrored, changed or not.
+    synced = set()
+    if not os.path.isdir(source_path):
+        return synced
+    updated = 0
+    for dirpath, dirnames, filenames in os.walk(source_path):
+        ignored = set(ignore(dirpath, dirnames + filenames)) if ignore else set()
+        dirnames[:] = [x for x in dirnames if x not in ignored]
+        relative_dirpath = os.path.relpath(dirpath, source_path)
+        os.makedirs(os.path.join(target_path, relative_dirpath), exist_ok=True)
+        for filename in filenames:
+            if filename in ignored:
+                continue
+            relative_filepath = os.path.normpath(os.path.join(relative_dirpath, filename))
+            source_filepath = os.path.join(source_path, relative_filepath)
+            target_filepath = os.path.join(target_path, relative_filepath)
+            if is_stale(source_filepath, target_filepath):
+                link_or_copy(source_filepath, target_filepath)
+                updated += 1
+            synced.add(relative_filepath)
+    logger.info("Synced %d files, %d updated: %s -> %s", len(synced), updated, source_path, target_path)
+    return synced
+
+
+def iter_tree(source_path, ignore=None):
+    # Relative path of every file under source_path in a stable order, filtered like sync_tree
+    if not os.path.isdir(source_path):
+        return
+    for dirpath, dirnames, filenames in os.walk(source_path):
+        ignored = set(ignore(dirpath, dirnames + filenames)) if ignore else set()
+        dirnames[:] = sorted(x for x in dirnames if x not in ignored)
+        relative_dirpath = os.path.relpath(dirpath, source_path)
+        for filename in sorted(filenames):
+            if filename not in ignored:
+                yield os.path.normpath(os.path.join(relative_dirpath, filename))
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def set_mode(temp_filepath, filepath):
+    # Temporary files are created private (0600), give them the mode of the file they replace or the
+    # mode a newly created file would get
+    if os.path.exists(filepath):
+        mode = stat.S_IMODE(os.stat(filepath).st_mode)
+    else:
+        mode = 0o666 & ~get_umask()
+    os.chmod(temp_filepath, mode)
+
+
+def write_if_changed(filepath, data):
+    # Atomically replace the file with data, unless it already holds exactly those bytes
+    if os.path.isfile(filepath) and os.path.getsize(filepath) == len(data):
+        if open(filepath, 'rb').read() == data:
+            return False
+    directory = os.path.dirname(filepath)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_filepath = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        set_mode(temp_filepath, filepath)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+    return True
+
+
+def write_chunks_if_changed(filepath, chunks):
+    # Streaming write_if_changed, chunks are written to a temporary file that only replaces the file
+    # when their content differs.  Returns whether the file changed along with the bytes written.
+    directory = os.path.dirname(filepath)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_filepath = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        if os.path.isfile(filepath) and filecmp.cmp(temp_filepath, filepath, shallow=False):
+            os.remove(temp_filepath)
+            return False, size
+        set_mode(temp_filepath, filepath)
+        os.replace(temp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+    return True, size
+
+
+def prune_tree(target_path, keep):
+    # Remove files (and then empty directories) that aren't in the set of relative paths to keep
+    keep = {os.path.normcase(os.path.normpath(x)) for x in keep}
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(target_path, topdown=False):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if os.path.normcase(os.path.relpath(filepath, target_path)) not in keep:
+                os.remove(filepath)
+                removed += 1
+        if dirpath != target_path and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+    if removed:
+        logger.info("Pruned %d stale files: %s", removed, target_path)
+    return removed
@@ -0,0 +1,150 @@
+import os
+import re
+import marshal
+
+from . import cache
+from . import serializer
+
+PLACEHOLDER_PATTERN = re.compile(r'\$([A-Z_]+)')
+
+# Compiled templates shared by every project and dialog using the same templates directory
+_registries = {}
+
+
+def find_static_storables(node, path=()):
+    # Yields the path to every storable without a placeholder, these render the same every time
+    if isinstance(node, dict):
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        return
+    for key, value in items:
+        if key == 'storables' and isinstance(value, list):
+            for idx, storable in enumerate(value):
+                if not any(find_placeholders(storable)):
+                    yield path + (key, idx)
+        else:
+            yield from find_static_storables(value, path + (key,))
+
+
+def find_placeholders(node, path=()):
+    # Yields the path to every string value containing a placeholder along with its split parts
+    if isinstance(node, dict):
+        items = node.items()
+    elif isinstance(node, list):
+        items = enumerate(node)
+    else:
+        if isinstance(node, str) and '$' in node and PLACEHOLDER_PATTERN.search(node):
+            yield path, PLACEHOLDER_PATTERN.split(node)
+        return
+    for key, value in items:
+        yield from find_placeholders(value, path + (key,))
+
+
+def get_node(node, path):
+    for key in path:
+        node = node[key]
+    return node
+
+
+class Template(object):
+    def __init__(self, data):
+        # Parsed data is frozen into a marshal blob, which is much cheaper to load than json,
+        # along with the location of every placeholder so values can be patched in place.
+        # Strings stay interned through marshal so every render shares them.
+        self.blob = marshal.dumps(data)
+        self.slots = list(find_placeholders(data))
+
+        # A second blob without the static storables, which shared renders all point to instead
+        self.static = [(path, get_node(data, path)) for path in find_static_storables(data)]
+        for path, storable in self.static:
+            get_node(data, path[:-1])[path[-1]] = None
+        self.shared_blob = marshal.dumps(data)
+
+    @staticmethod
+    def load(filepath):
+        return Template(cache.load(filepath, interned=True))
+
+    def render(self, **values):
+        # Placeholders are given without their '$' prefix, ie. render(ID='Girl#2')
+        return self.patch(marshal.loads(self.blob), values)
+
+    def render_shared(self, **values):
+        # Storables without placeholders are the same objects in every render, they must only be
+        # written to through copy on write wrappers (ie, Atom(data, shared=True))
+        data = marshal.loads(self.shared_blob)
+        for path, storable in self.static:
+            get_node(data, path[:-1])[path[-1]] = storable
+        return self.patch(data, values)
+
+    def patch(self, data, values):
+        values = {key: str(value) for key, value in values.items()}
+        for path, parts in self.slots:
+            node = data
+            for key in path[:-1]:
+                node = node[key]
+            node[path[-1]] = ''.join(part if idx % 2 == 0 else values.get(part, '$' + part)
+                                     for idx, part in enumerate(parts))
+        return data
+
+
+class TemplateRegistry(object):
+    def __init__(self, templates_path):
+        self.templates_path = templates_path
+        if not os.path.isdir(self.templates_path):
+            raise FileNotFoundError("Template directory not found!")
+        self.templates = {}
+
+    @staticmethod
+    def get_registry(templates_path):
+        # Registries can also be passed around in place of their path, ie. a MemoryTemplateRegistry
+        if isinstance(templates_path, TemplateRegistry):
+            return templates_path
+        registry = _registries.get(templates_path)
+        if not registry:
+            registry = TemplateRegistry(templates_path)
+            _registries.update({templates_path: registry})
+        return registry
+
+    def get(self, name):
+        # Templates are compiled once and only recompiled if the file changes on disk
+        filepath = os.path.join(self.templates_path, '%s.json' % name.replace('/', os.sep))
+        stat = os.stat(filepath)
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self.templates.get(filepath)
+        if cached and cached[0] == key:
+            return cached[1]
+        template = Template.load(filepath)
+        self.templates.update({filepath: (key, template)})
+        return template
+
+    def render(self, name, **values):
+        return self.get(name).render(**values)
+
+    def render_shared(self, name, **values):
+        return self.get(name).render_shared(**values)
+
+
+class MemoryTemplateRegistry(TemplateRegistry):
+    def __init__(self, templates):
+        # Templates by name (ie, 'default' or 'packages/Girl') as parsed json or raw bytes
+        self.templates_path = None
+        self.sources = dict(templates)
+        self.templates = {}
+
+    def get(self, name):
+        template = self.templates.get(name)
+        if template:
+            return template
+        if name not in self.sources:
+            raise KeyError("Template not found: %s" % name)
+        data = self.sources[name]
+        if isinstance(data, (bytes, str)):
+            data = serializer.loads(data, interned=True)
+        else:
+            # Compiling takes apart the data it's given, so work from a copy
+            data = serializer.intern_data(marshal.loads(marshal.dumps(data)))
+        template = Template(data)
+        self.templates.update({name: template})
+        return template
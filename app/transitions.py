@@ -0,0 +1,94 @@
+from .index import AtomIndex
+from .manifest import hash_data
+from . import serializer
+
+
+def count_bits(mask):
+    return bin(mask).count('1')
+
+
+class Transitions(object):
+    def __init__(self, scenes, story=None):
+        # Scenes are keyed by their path, story maps each scene to the scenes that may follow it
+        self.scene_paths = list(scenes.keys())
+        self.story = story or {}
+        self.index = AtomIndex(scenes)
+        # Every atom is reduced to a digest of its content and the bytes VAM has to load for it,
+        # so comparing two scenes is a set difference
+        self.states = {}
+        self.sizes = {}
+        for scene_path, scene in scenes.items():
+            states = set()
+            for atom_id, atom in scene.atoms.items():
+                data = atom.build()
+                state = (atom_id, hash_data(data))
+                states.add(state)
+                self.sizes[state] = len(serializer.dumps(data))
+            self.states[scene_path] = states
+        self.costs = {}
+
+    def get_cost(self, from_scene_path, to_scene_path):
+        # Merge-loading to_scene over from_scene adds its missing atoms, updates atoms whose state
+        # differs and leaves behind atoms it doesn't have
+        key = (from_scene_path, to_scene_path)
+        cost = self.costs.get(key)
+        if cost is None:
+            added, removed = self.index.get_difference(from_scene_path, to_scene_path)
+            states = self.states[to_scene_path] - self.states[from_scene_path]
+            cost = {
+                'added': count_bits(added),
+                'removed': count_bits(removed),
+                'changed': len(states) - count_bits(added),
+                'bytes': sum(self.sizes[state] for state in states)
+            }
+            self.costs.update({key: cost})
+        return cost
+
+    def get_matrix(self):
+        return {from_scene_path: {to_scene_path: self.get_cost(from_scene_path, to_scene_path)
+                                  for to_scene_path in self.scene_paths if to_scene_path != from_scene_path}
+                for from_scene_path in self.scene_paths}
+
+    def get_story_costs(self):
+        costs = []
+        for from_scene_path, to_scene_paths in self.story.items():
+            for to_scene_path in to_scene_paths:
+                cost = dict(self.get_cost(from_scene_path, to_scene_path))
+                cost.update({'from': from_scene_path, 'to': to_scene_path})
+                costs.append(cost)
+        return costs
+
+    def get_order_cost(self, scene_paths):
+        return sum(self.get_cost(scene_paths[idx], scene_paths[idx + 1])['bytes']
+                   for idx in range(len(scene_paths) - 1))
+
+    def get_order(self):
+        # Greedy walk from the first scene, always moving to the cheapest scene the story allows next.
+        # Scenes the story can't reach yet (or every scene without a story) are candidates once it stalls.
+        if not self.scene_paths:
+            return []
+        order = [self.scene_paths[0]]
+        remaining = self.scene_paths[1:]
+        while remaining:
+            reachable = {to_scene_path for scene_path in order for to_scene_path in self.story.get(scene_path, [])}
+            candidates = [x for x in remaining if x in reachable] or remaining
+            current = order[-1]
+            cheapest = min(candidates, key=lambda x: self.get_cost(current, x)['bytes'])
+            order.append(cheapest)
+            remaining.remove(cheapest)
+        return order
+
+    def report(self):
+        order = self.get_order()
+        return {
+            'scenes': self.scene_paths,
+            'matrix': self.get_matrix(),
+            'story': self.get_story_costs(),
+            'order': {
+                'configured': {'scenes': self.scene_paths, 'bytes': self.get_order_cost(self.scene_paths)},
+                'suggested': {'scenes': order, 'bytes': self.get_order_cost(order)}
+            }
+        }
+
+    def save(self, filepath):
+        serializer.dump(self.report(), filepath, pretty=True)
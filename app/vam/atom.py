@@ -4,17 +4,61 @@ from .storable import Storable
 
 
 class Atom(object):
-    def __init__(self, data):
-        self.data = data
-        self.storables = {data.get('id'): Storable(data) for data in self.data['storables']}
+    # Projects hold a wrapper per atom and storable in every scene, slots keep them small
+    __slots__ = ('_data', 'shared', '_storables', 'storables_shared')
+
+    def __init__(self, data, shared=False):
+        self._data = data
+        self.shared = shared
+        # Storables are only wrapped once something asks for them, untouched atoms stay as parsed
+        self._storables = None
+        self.storables_shared = shared
+
+    @property
+    def data(self):
+        # Copy on write, storables are left alone as they manage their own copies
+        if self.shared:
+            self._data = {key: value if key == 'storables' else copy.deepcopy(value)
+                          for key, value in self._data.items()}
+            self.shared = False
+        return self._data
+
+    @property
+    def storables(self):
+        if self._storables is None:
+            self._storables = {data.get('id'): Storable(data, self.storables_shared)
+                               for data in self._data['storables']}
+        return self._storables
+
+    def get(self, key, default=None):
+        # Read a field without taking a private copy
+        return self._data.get(key, default)
+
+    def get_storable_count(self):
+        return len(self._data['storables'] if self._storables is None else self._storables)
 
     def build(self):
-        data = copy.deepcopy(self.data)
-        data['storables'] = [storable.build() for storable in self.storables.values()]
+        # Output is shared with this atom and must only be read (ie, serialized)
+        if self._storables is None:
+            return self._data
+        data = dict(self._data)
+        data['storables'] = [storable.build() for storable in self._storables.values()]
         return data
 
     def copy(self):
-        return Atom(self.build())
+        # Both atoms read the same data until one of them writes to it
+        self.shared = True
+        self.storables_shared = True
+        atom = Atom(self._data, shared=True)
+        if self._storables is not None:
+            atom._storables = {storable_id: storable.copy() for storable_id, storable in self._storables.items()}
+        return atom
+
+    def stub(self, keys, storable_ids):
+        # Stripped down copy on write atom containing only the given fields and storables
+        data = {key: value for key, value in self._data.items() if key in keys}
+        data['storables'] = [storable for storable in self.build()['storables'] if storable.get('id') in storable_ids]
+        return Atom(data, shared=True)
 
     def merge(self, data):
         self.data.update(data)
@@ -1,34 +1,74 @@
 import os
-import copy
-import json
 
 from .atom import Atom
+from .. import cache
+from .. import serializer
+
+# Atoms found in the scene itself, as opposed to those packed into it
+SOURCE_ORIGINAL = 'original'
 
 
 class Scene(object):
-    def __init__(self, data, dialog=None):
+    __slots__ = ('data', 'dialog', '_atoms', 'shared', 'sources')
+
+    def __init__(self, data, dialog=None, shared=False):
         self.data = data
         self.dialog = dialog
-        self.atoms = {atom.get('id'): Atom(atom) for atom in self.data['atoms']}
+        # Atoms are only wrapped once something asks for them, untouched scenes are saved as parsed
+        self._atoms = None
+        self.shared = shared
+        # Where each packed atom came from (ie, a package), see pack
+        self.sources = {}
+
+    @property
+    def atoms(self):
+        if self._atoms is None:
+            self._atoms = {atom.get('id'): Atom(atom, self.shared) for atom in self.data['atoms']}
+        return self._atoms
 
     @staticmethod
     def load(filepath):
         if not os.path.isfile(filepath):
             raise FileNotFoundError()
-        return Scene(json.load(open(filepath, 'r')))
+        return Scene(cache.load(filepath, interned=True))
 
     def build(self):
-        data = copy.deepcopy(self.data)
-        data['atoms'] = [atom.build() for atom in self.atoms.values()]
+        # Output is shared with this scene and must only be read (ie, serialized)
+        if self._atoms is None:
+            return self.data
+        data = dict(self.data)
+        data['atoms'] = [atom.build() for atom in self._atoms.values()]
         return data
 
+    def iter_dumps(self):
+        # Serialized scene, encoded an atom at a time (see serializer.iter_dumps)
+        atoms = self.data['atoms'] if self._atoms is None else (atom.build() for atom in self._atoms.values())
+        return serializer.iter_dumps(self.data, 'atoms', atoms)
+
     def copy(self):
-        return Scene(self.build())
+        # Both scenes read the same atoms until one of them writes to one
+        self.shared = True
+        scene = Scene(dict(self.data), self.dialog, shared=True)
+        scene.sources = dict(self.sources)
+        if self._atoms is not None:
+            scene._atoms = {atom_id: atom.copy() for atom_id, atom in self._atoms.items()}
+        return scene
 
     def merge(self, data):
         self.data.update(data)
 
-    def pack(self, atoms):
+    def get_source(self, atom_id):
+        return self.sources.get(atom_id, SOURCE_ORIGINAL)
+
+    def pack(self, atoms, source=None):
+        # Only atoms the scene is missing are packed, in the order they were given
+        missing = atoms.keys() - self.atoms.keys()
+        if not missing:
+            return 0
         for atom_id, atom in atoms.items():
-            if not self.atoms.get(atom_id):
-                self.atoms.update({atom_id: atom})
+            if atom_id in missing:
+                # Each scene gets its own copy on write view of the atom
+                self.atoms.update({atom_id: atom.copy()})
+                if source:
+                    self.sources.update({atom_id: source})
+        return len(missing)
@@ -2,15 +2,28 @@ import copy
 
 
 class Storable(object):
-    def __init__(self, data):
-        self.data = data
+    __slots__ = ('_data', 'shared')
+
+    def __init__(self, data, shared=False):
+        self._data = data
+        self.shared = shared
+
+    @property
+    def data(self):
+        # Copy on write, data handed out here may be mutated so take a private copy first
+        if self.shared:
+            self._data = copy.deepcopy(self._data)
+            self.shared = False
+        return self._data
 
     def build(self):
-        data = copy.deepcopy(self.data)
-        return data
+        # Output is shared with this storable and must only be read (ie, serialized)
+        return self._data
 
     def copy(self):
-        return Storable(self.build())
+        # Both storables read the same data until one of them writes to it
+        self.shared = True
+        return Storable(self._data, shared=True)
 
     def merge(self, data):
         self.data.update(data)
@@ -0,0 +1,55 @@
+import os
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(object):
+    def __init__(self, get_paths, interval=0.25):
+        # get_paths is called on every poll so directories created after startup are picked up
+        self.get_paths = get_paths
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        for path in self.get_paths():
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                state.update({path: (stat.st_size, stat.st_mtime_ns)})
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(filepath)
+                    except FileNotFoundError:
+                        continue
+                    state.update({filepath: (stat.st_size, stat.st_mtime_ns)})
+        return state
+
+    def poll(self):
+        # Returns every file added, changed or removed since the last poll
+        state = self.scan()
+        changed = [path for path, key in state.items() if self.state.get(path) != key]
+        changed += [path for path in self.state.keys() if path not in state]
+        self.state = state
+        return changed
+
+    def wait(self):
+        # Blocks until something changes, waiting for writes to settle before returning
+        while True:
+            time.sleep(self.interval)
+            changed = self.poll()
+            if not changed:
+                continue
+            while True:
+                time.sleep(self.interval)
+                settled = self.poll()
+                if not settled:
+                    break
+                changed += settled
+            logger.info("Detected %d changed files.", len(changed))
+            return sorted(set(changed))
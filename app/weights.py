@@ -0,0 +1,84 @@
+import os
+
+from .index import get_prefix
+from . import serializer
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Number of heaviest atoms (per scene) and scenes (per project) reported
+TOP_ATOMS = 10
+TOP_SCENES = 10
+
+
+def add_weight(weights, key, atoms=0, storables=0, size=0):
+    weight = weights.setdefault(key, {'atoms': 0, 'storables': 0, 'bytes': 0})
+    weight['atoms'] += atoms
+    weight['storables'] += storables
+    weight['bytes'] += size
+
+
+def get_scene_weights(scene, package_source):
+    # Atom, storable and byte counts of a scene broken down by where each atom came from.  Atoms
+    # are serialized one by one, the rest of the scene file is reported as its own source.
+    weights = {'sources': {}, 'packages': {}, 'heaviest': []}
+    atom_sizes = []
+    for atom_id, atom in scene.atoms.items():
+        source = scene.get_source(atom_id)
+        storables = atom.get_storable_count()
+        size = len(serializer.dumps(atom.build()))
+        add_weight(weights['sources'], source, 1, storables, size)
+        if source == package_source:
+            add_weight(weights['packages'], get_prefix(atom_id), 1, storables, size)
+        atom_sizes.append({'id': atom_id, 'source': source, 'storables': storables, 'bytes': size})
+
+    total = len(serializer.dumps(scene.build()))
+    atom_total = sum(x['bytes'] for x in atom_sizes)
+    weights.update({
+        'atoms': len(atom_sizes),
+        'storables': sum(x['storables'] for x in atom_sizes),
+        'bytes': total,
+        'heaviest': sorted(atom_sizes, key=lambda x: x['bytes'], reverse=True)[:TOP_ATOMS]
+    })
+    add_weight(weights['sources'], 'scene', size=total - atom_total)
+    return weights
+
+
+class Weights(object):
+    def __init__(self, filepath):
+        # Scenes that weren't rebuilt keep the weights recorded by the build that last saved them
+        self.filepath = filepath
+        self.scenes = {}
+        if os.path.isfile(self.filepath):
+            try:
+                self.scenes = serializer.load(self.filepath).get('scenes', {})
+            except (ValueError, AttributeError):
+                logger.warning("Ignoring corrupt scene weights: %s", self.filepath)
+
+    def update(self, scene_weights, scene_paths):
+        self.scenes.update(scene_weights)
+        self.scenes = {scene_path: self.scenes[scene_path] for scene_path in scene_paths
+                       if scene_path in self.scenes}
+
+    def report(self):
+        totals = {'atoms': 0, 'storables': 0, 'bytes': 0, 'sources': {}, 'packages': {}}
+        for weights in self.scenes.values():
+            for key in ['atoms', 'storables', 'bytes']:
+                totals[key] += weights[key]
+            for group in ['sources', 'packages']:
+                for key, weight in weights[group].items():
+                    add_weight(totals[group], key, weight['atoms'], weight['storables'], weight['bytes'])
+        for group in ['sources', 'packages']:
+            for weight in totals[group].values():
+                weight['share'] = weight['bytes'] / totals['bytes'] if totals['bytes'] else 0
+        heaviest = sorted(self.scenes.items(), key=lambda x: x[1]['bytes'], reverse=True)[:TOP_SCENES]
+        return {
+            'scenes': self.scenes,
+            'totals': totals,
+            'heaviest': [{'scene': scene_path, 'bytes': weights['bytes'], 'atoms': weights['atoms']}
+                         for scene_path, weights in heaviest]
+        }
+
+    def save(self):
+        serializer.dump(self.report(), self.filepath, pretty=True)
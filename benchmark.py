@@ -0,0 +1,87 @@
+import os
+import sys
+import argparse
+
+from app.benchmark import Benchmark, DIALOG_SHAPES
+from app import serializer
+
+import logging
+
+
+def parse_packages(value):
+    # ie. "Guy=1,Girl=2,Nav=1"
+    packages = {}
+    for item in filter(None, value.split(',')):
+        name, _, count = item.partition('=')
+        packages.update({name.strip(): int(count or 1)})
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark project scaffolding against a generated project.')
+    parser.add_argument('--scenes', type=int, default=10, help='number of scenes in the project')
+    parser.add_argument('--packages', type=parse_packages, default='Guy=1,Girl=1,Light=1',
+                        help='package counts for blueprint.json, ie. Guy=1,Girl=2,Nav=1')
+    parser.add_argument('--unique-atoms', type=int, default=5, help='atoms only found in a single scene')
+    parser.add_argument('--unique-atom-package', default='Toy', help='package used to create unique atoms')
+    parser.add_argument('--dialog-size', type=int, default=0, help='number of dialog passages, 0 for no dialog')
+    parser.add_argument('--dialog-shape', choices=DIALOG_SHAPES, default='mixed')
+    parser.add_argument('--dialog-fan-out', type=int, default=3, help='number of choices per dialog prompt')
+    parser.add_argument('--workers', type=int, default=1, help='number of scenes to build in parallel')
+    parser.add_argument('--low-memory', action='store_true', help='build one scene at a time in two passes')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported')
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory tracing (it slows down runs)')
+    parser.add_argument('--templates', default=os.path.join('.', 'templates'), help='templates directory')
+    parser.add_argument('--serializers', action='store_true', help='compare json backends instead of the scaffold')
+    parser.add_argument('--output', help='save results as json to this file')
+    parser.add_argument('--compare', help='compare results against a previously saved json file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    benchmark = Benchmark(
+        templates_path=args.templates,
+        scene_count=args.scenes,
+        packages=args.packages,
+        unique_atoms=args.unique_atoms,
+        unique_atom_package=args.unique_atom_package,
+        dialog_size=args.dialog_size,
+        dialog_shape=args.dialog_shape,
+        dialog_fan_out=args.dialog_fan_out,
+        workers=args.workers,
+        low_memory=args.low_memory,
+        trace_memory=not args.no_memory
+    )
+    if args.serializers:
+        result = benchmark.run_serializers(repeat=args.repeat)
+        print("%d scenes, %.1f MB" % (result['scenes'], result['input_bytes'] / 1024 / 1024))
+        for backend, timing in result['backends'].items():
+            print("  %-8s load %7.3fs  dump %7.3fs  %s" % (
+                backend, timing['load'], timing['dump'],
+                'identical' if timing['identical'] else 'equivalent' if timing['equivalent'] else 'DIFFERENT'))
+        if args.output:
+            serializer.dump(result, args.output, pretty=True)
+        return 0
+
+    result = benchmark.run(repeat=args.repeat)
+
+    best = result['best']
+    print("Total: %.3fs" % best['total'])
+    for phase, timing in best['phases'].items():
+        print("  %-20s %8.3fs  (%d calls)" % (phase, timing['time'], timing['calls']))
+    if best['peak_memory'] is not None:
+        print("Peak memory: %.1f MB" % (best['peak_memory'] / 1024 / 1024))
+    print("Output: %.1f MB" % (best['output_bytes'] / 1024 / 1024))
+
+    if args.compare:
+        baseline = serializer.load(args.compare)
+        for phase, change in Benchmark.compare(baseline, result).items():
+            print("  %-20s %+7.1f%%" % (phase, change * 100))
+
+    if args.output:
+        serializer.dump(result, args.output, pretty=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,37 +1,246 @@
 import os
-import json
+import sys
+import time
+import argparse
+import multiprocessing
+
+from logging.handlers import QueueListener
 
 from app.project import Project
+from app.sinks import DEFAULT_COMPRESSION
+from app.watcher import Watcher
+from app import serializer
+from app import cache
+from app import log
 
 import logging
-logging.basicConfig(
-    filename='output.log',
-    filemode='a',
-    format='%(process)d - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
-
-config = json.load(open('config.json', 'r'))
-VAM_PATH = config.get('VAM_PATH')
-SCENES_PATH = os.path.join(VAM_PATH, 'Saves', 'scene')
-PROJECTS_PATH = config.get('PROJECTS_PATH', os.path.join('.', 'projects'))
-TEMPLATES_PATH = config.get('TEMPLATES_PATH', os.path.join('.', 'templates'))
-
-try:
-    if not os.path.isdir(VAM_PATH):
-        raise FileNotFoundError("VAM_PATH not set or does not exist!  Please specify in config.json.")
-    if not os.path.isdir(PROJECTS_PATH):
-        raise FileNotFoundError("Could not find PROJECTS_PATH! Are you sure it exists?")
-    if not os.path.isdir(TEMPLATES_PATH):
-        raise FileNotFoundError("Could not find TEMPLATES_PATH! Are you sure it exists?")
-
-    for project_name in os.listdir(PROJECTS_PATH):
+
+logger = log.get_logger('build')
+
+
+def init_project_worker(log_queue, levels, json_backend, cache_settings):
+    # Project workers start with their parent's settings, they aren't inherited by spawned processes
+    log.init_worker_logging(log_queue, levels)
+    serializer.set_backend(json_backend)
+    cache.set_cache(*cache_settings)
+
+
+def scaffold_project(project_name, projects_path, templates_path, scenes_path, force=False, workers=1,
+                     profile=False, cache=None, transitions=False, weights=False, scenes=None, changed=None,
+                     low_memory=False, check=False, package_path=None, compression=DEFAULT_COMPRESSION):
+    try:
         project = Project(
             name=project_name,
-            projects_path=PROJECTS_PATH,
-            templates_path=TEMPLATES_PATH,
-            scenes_path=SCENES_PATH
+            projects_path=projects_path,
+            templates_path=templates_path,
+            scenes_path=scenes_path,
+            workers=workers,
+            profile=profile,
+            cache=cache,
+            transitions=transitions,
+            weights=weights,
+            low_memory=low_memory,
+            check=check,
+            package_path=package_path,
+            compression=compression
         )
-        project.scaffold()
-except Exception as e:
-    logging.exception(e)
+        scene_paths = project.select_scenes(scenes, changed)
+        if scene_paths == []:
+            logger.info("No scenes selected, skipping: %s", project_name)
+            return project_name, None
+        project.scaffold(force=force, scene_paths=scene_paths)
+    except Exception as e:
+        logger.exception("Failed to build project: %s", project_name)
+        return project_name, '%s: %s' % (type(e).__name__, e)
+    return project_name, None
+
+
+def get_affected_projects(changed, projects_path, templates_path, scenes_path):
+    # Template changes affect the projects built from them, anything else belongs to the project it's filed under
+    project_names = [x for x in os.listdir(projects_path) if os.path.isdir(os.path.join(projects_path, x))]
+    affected = set()
+    template_paths = [x for x in changed if not os.path.relpath(x, templates_path).startswith('..')]
+    for path in changed:
+        for root_path in [projects_path, scenes_path]:
+            relative_path = os.path.relpath(path, root_path)
+            if not relative_path.startswith('..'):
+                affected.add(relative_path.split(os.sep)[0])
+    if template_paths:
+        for project_name in project_names:
+            try:
+                project = Project(project_name, projects_path, templates_path, scenes_path)
+                if project.get_graph().get_dependents(*template_paths):
+                    affected.add(project_name)
+            except Exception:
+                # Let the build report whatever is wrong with the project
+                affected.add(project_name)
+    return [x for x in project_names if x in affected]
+
+
+def watch_projects(projects_path, templates_path, scenes_path, workers=1, interval=0.25, **options):
+    # Projects stay loaded between builds so only changed files are parsed again.  Every other option
+    # (ie, check or package_path) is passed on to scaffold_project, each build runs like a single build.
+    caches = {}
+
+    def get_paths():
+        paths = [projects_path, templates_path]
+        paths += [os.path.join(scenes_path, x) for x in os.listdir(projects_path)
+                  if os.path.isdir(os.path.join(scenes_path, x))]
+        return paths
+
+    def build(project_names):
+        for project_name in project_names:
+            start = time.perf_counter()
+            project_name, error = scaffold_project(project_name, projects_path, templates_path, scenes_path,
+                                                   workers=workers, cache=caches.setdefault(project_name, {}),
+                                                   **options)
+            if error:
+                print("Failed to build %s: %s" % (project_name, error))
+            else:
+                print("Built %s in %.2fs" % (project_name, time.perf_counter() - start))
+
+    build([x for x in os.listdir(projects_path) if os.path.isdir(os.path.join(projects_path, x))])
+    watcher = Watcher(get_paths, interval)
+    print("Watching for changes, press Ctrl+C to stop..")
+    try:
+        while True:
+            changed = watcher.wait()
+            build(get_affected_projects(changed, projects_path, templates_path, scenes_path))
+            if cache.get_cache():
+                cache.get_cache().prune()
+    except KeyboardInterrupt:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scaffold merge-load compatible VAM scenes from project blueprints.')
+    parser.add_argument('projects', nargs='*', help='projects to build, defaults to every project')
+    parser.add_argument('--scene', action='append', dest='scenes',
+                        help='only build scenes matching this path or pattern (ie, SceneA.json or chapter1/*)')
+    parser.add_argument('--changed', action='append',
+                        help='only build scenes depending on this file (ie, templates/packages/Girl.json)')
+    parser.add_argument('--force', action='store_true', help='ignore build manifests and rebuild every project from scratch')
+    parser.add_argument('--workers', type=int, default=None, help='number of projects to build in parallel')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile each project with cProfile and tracemalloc (slow), saved next to the build')
+    parser.add_argument('--json-backend', choices=serializer.BACKENDS,
+                        help='json library used to read and write files, defaults to the fastest installed')
+    parser.add_argument('--watch', action='store_true', help='keep running and rebuild projects as their files change')
+    parser.add_argument('--interval', type=float, default=0.25, help='seconds between checks for changes in watch mode')
+    parser.add_argument('--scene-workers', type=int, default=None, help='number of scenes to build in parallel per project')
+    parser.add_argument('--weights', action='store_true',
+                        help='report atoms, storables and bytes in each scene by where they came from')
+    parser.add_argument('--check', action='store_true',
+                        help='analyze dialogs before building and fail projects with broken dialogs')
+    parser.add_argument('--low-memory', action='store_true',
+                        help='build one scene at a time in two passes, writing each scene as it is encoded')
+    parser.add_argument('--var', action='store_true',
+                        help='write each project as a .var package in VAR_PATH (AddonPackages) instead of loose files')
+    parser.add_argument('--compression', type=int, choices=range(10), metavar='0-9',
+                        help='compression level of .var packages, 0 stores files uncompressed')
+    parser.add_argument('--no-cache', action='store_true', help='parse every file from scratch, skipping the parse cache')
+    parser.add_argument('--transitions', action='store_true',
+                        help='report the merge-load cost between every pair of scenes, saved next to the build')
+    parser.add_argument('--log-level', action='append', dest='log_levels', metavar='[SUBSYSTEM=]LEVEL',
+                        help='log at this level (ie, DEBUG) or only a subsystem at it (ie, dialog=DEBUG)')
+    parser.add_argument('--log-format', choices=log.FORMATS, help='write output.log as text or one json event per line')
+    args = parser.parse_args()
+
+    config = serializer.load('config.json')
+    levels = {'': config['LOG_LEVEL']} if config.get('LOG_LEVEL') else {}
+    levels.update(config.get('LOG_LEVELS', {}))
+    levels.update(log.parse_levels(args.log_levels))
+    log_format = args.log_format or config.get('LOG_FORMAT', log.FORMAT_TEXT)
+    try:
+        listener = log.start_logging('output.log', levels, log_format)
+    except Exception as e:
+        print("Could not start logging: %s" % e)
+        return 1
+    try:
+        return run(args, config)
+    finally:
+        log.stop_logging(listener)
+
+
+def run(args, config):
+    VAM_PATH = config.get('VAM_PATH')
+    SCENES_PATH = os.path.join(VAM_PATH, 'Saves', 'scene')
+    PROJECTS_PATH = config.get('PROJECTS_PATH', os.path.join('.', 'projects'))
+    TEMPLATES_PATH = config.get('TEMPLATES_PATH', os.path.join('.', 'templates'))
+    WORKERS = args.workers or config.get('WORKERS', 1)
+    SCENE_WORKERS = args.scene_workers or config.get('SCENE_WORKERS', 1)
+    JSON_BACKEND = args.json_backend or config.get('JSON_BACKEND')
+    CACHE_PATH = None if args.no_cache else config.get('CACHE_PATH', os.path.join('.', '.vsb-cache'))
+    CACHE_SIZE = config.get('CACHE_SIZE', 256)
+    LOW_MEMORY = args.low_memory or config.get('LOW_MEMORY', False)
+    VAR = args.var or config.get('VAR', False)
+    VAR_PATH = config.get('VAR_PATH', os.path.join(VAM_PATH, 'AddonPackages')) if VAR else None
+    VAR_COMPRESSION = config.get('VAR_COMPRESSION', DEFAULT_COMPRESSION) if args.compression is None \
+        else args.compression
+
+    try:
+        if JSON_BACKEND:
+            serializer.set_backend(JSON_BACKEND)
+        cache.set_cache(CACHE_PATH, CACHE_SIZE * 1024 * 1024)
+        if not os.path.isdir(VAM_PATH):
+            raise FileNotFoundError("VAM_PATH not set or does not exist!  Please specify in config.json.")
+        if not os.path.isdir(PROJECTS_PATH):
+            raise FileNotFoundError("Could not find PROJECTS_PATH! Are you sure it exists?")
+        if not os.path.isdir(TEMPLATES_PATH):
+            raise FileNotFoundError("Could not find TEMPLATES_PATH! Are you sure it exists?")
+    except Exception:
+        logger.exception("Could not start the build")
+        return 1
+
+    if args.watch:
+        if args.changed:
+            logger.error("--changed can't be used with --watch, changed files are found by watching")
+            return 1
+        return watch_projects(PROJECTS_PATH, TEMPLATES_PATH, SCENES_PATH, SCENE_WORKERS, args.interval,
+                              force=args.force, profile=args.profile, transitions=args.transitions,
+                              weights=args.weights, scenes=args.scenes, low_memory=LOW_MEMORY, check=args.check,
+                              package_path=VAR_PATH, compression=VAR_COMPRESSION)
+
+    project_names = [x for x in os.listdir(PROJECTS_PATH) if os.path.isdir(os.path.join(PROJECTS_PATH, x))]
+    unknown = [x for x in args.projects if x not in project_names]
+    if unknown:
+        logger.error("Projects not found: %s", ', '.join(unknown))
+        return 1
+    if args.projects:
+        project_names = [x for x in project_names if x in args.projects]
+    parallel = WORKERS > 1 and len(project_names) > 1
+
+    # Worker processes cannot start their own pools, so scenes are only built in parallel in serial project mode
+    jobs = [(project_name, PROJECTS_PATH, TEMPLATES_PATH, SCENES_PATH, args.force, 1 if parallel else SCENE_WORKERS,
+             args.profile, None, args.transitions, args.weights, args.scenes, args.changed, LOW_MEMORY,
+             args.check, VAR_PATH, VAR_COMPRESSION)
+            for project_name in project_names]
+
+    if parallel:
+        logger.info("Building %d projects with %d workers.", len(jobs), WORKERS)
+        log_queue = multiprocessing.Queue()
+        listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        listener.start()
+        try:
+            with multiprocessing.Pool(min(WORKERS, len(jobs)), initializer=init_project_worker,
+                                      initargs=(log_queue, log.get_levels(), serializer.get_backend(),
+                                                cache.get_settings())) as pool:
+                results = pool.starmap(scaffold_project, jobs, chunksize=1)
+        finally:
+            listener.stop()
+    else:
+        results = [scaffold_project(*job) for job in jobs]
+
+    if cache.get_cache():
+        cache.get_cache().prune()
+
+    failures = [(project_name, error) for project_name, error in results if error]
+    for project_name, error in failures:
+        logger.error("Project failed to build: %s (%s)", project_name, error)
+    logger.info("Built %d of %d projects.", len(results) - len(failures), len(results))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())